@@ -37,15 +37,16 @@ def set_acl_match_attributes(client_context):
     if hasattr(client_context, 'acl_match_attributes'):
         return
 
-    match_attributes = set([
+    match_attributes = [
         attr['id'] if isinstance(attr, dict) else attr
         for attr in client_context.attributes
-    ])
-    match_attributes.add('*')
+    ]
+    match_attributes.append('*')
     if client_context.client:
         client = client_context.client
-        match_attributes.add(client['id'] if isinstance(client, dict) else client)
-    client_context.acl_match_attributes = match_attributes
+        match_attributes.append(client['id'] if isinstance(client, dict) else client)
+    # frozen since it is shared by every ACL check for the rest of the request
+    client_context.acl_match_attributes = frozenset(match_attributes)
 
 def hatrac_debug(*args):
     """Shim for non-logger diagnostics
@@ -65,24 +66,21 @@ class web_storage(object):
 
     This is used in legacy code before migrating from web.py to flask.
     """
+    __slots__ = ('_d',)
+
     def __init__(self, *args, **kwargs):
         self._d = dict(*args, **kwargs)
 
-    def __getattribute__(self, a):
+    def __getattr__(self, a):
         """Allow reading of dict keys as attributes.
 
-        Don't allow dict keys to shadow actual attributes of dict, and
-        proxy those instead.
+        Python only calls this after normal attribute lookup fails, so
+        dict keys still cannot shadow actual attributes.
         """
-        sself = super(web_storage, self)
         try:
-            return sself.__getattribute__(a)
-        except:
-            d = sself.__getattribute__('_d')
-            if a in d:
-                return d[a]
-            else:
-                raise AttributeError(a)
+            return self._d[a]
+        except KeyError:
+            raise AttributeError(a)
 
 def coalesce(*args):
     for arg in args:
@@ -47,7 +47,10 @@ import binascii
 import base64
 import random
 import struct
-import datetime
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import psycopg2.pool
 from psycopg2.extras import DictCursor
@@ -55,24 +58,20 @@ from flask import request, g as hatrac_ctx
 
 from webauthn2.util import jsonWriter
 
-from ...core import coalesce, Metadata, sql_literal, sql_identifier, Redirect, hatrac_debug, web_storage, negotiated_content_type
+from ...core import Metadata, sql_literal, sql_identifier, Redirect, hatrac_debug, web_storage, negotiated_content_type
 from ... import core
 
-def regexp_escape(s):
-    safe = set(
-        [ chr(i) for i in range(ord('a'), ord('z')+1) ]
-        + [ chr(i) for i in range(ord('A'), ord('Z')+1) ]
-        + [ chr(i) for i in range(ord('0'), ord('9')+1) ]
-        + [ '/' ]
-    )
-               
-    def remap(c):
-        if c in safe:
-            return c
-        else:
-            return ''.join(('[', c, ']'))
-        
-    return ''.join([ remap(c) for c in s ])
+def json_body(doc):
+    """Returns nbytes, body for JSON doc with trailing newline.
+
+       The newline is yielded separately rather than copying the
+       serialized document just to append one byte.
+    """
+    return serialized_json_body(jsonWriter(doc))
+
+def serialized_json_body(body):
+    """Returns nbytes, body for already serialized JSON bytes with trailing newline."""
+    return len(body) + 1, iter([body, b'\n'])
 
 class ACLEntry (str):
     def is_object(self):
@@ -83,14 +82,22 @@ class ACLEntry (str):
         body = self + '\n'
         return len(body), Metadata({'content-type': 'text/plain'}), body
 
+# shared value for the many NULL ACL columns
+_EMPTY = frozenset()
+
 class ACL (set):
+    # serialized content, valid as ACL wrappers are rebuilt whenever the ACL changes
+    _json = None
+
     def is_object(self):
         return False
 
     def get_content(self, client_context, get_data=True):
         self.resource.enforce_acl(['owner', 'ancestor_owner'], client_context)
-        body = jsonWriter(list(self)) + b'\n'
-        return len(body), Metadata({'content-type': 'application/json'}), body
+        if self._json is None:
+            self._json = jsonWriter(list(self))
+        nbytes, body = serialized_json_body(self._json)
+        return nbytes, Metadata({'content-type': 'application/json'}), body
 
     def __getitem__(self, role):
         if role not in self:
@@ -102,13 +109,16 @@ class ACL (set):
         return entry
 
 class ACLs (dict):
+    _json = None
+
     def is_object(self):
         return False
 
     def get_content(self, client_context, get_data=True):
         self.resource.enforce_acl(['owner', 'ancestor_owner'], client_context)
-        body = jsonWriter(self.resource.get_acls()) + b'\n'
-        nbytes = len(body)
+        if self._json is None:
+            self._json = jsonWriter(self.resource.get_acls())
+        nbytes, body = serialized_json_body(self._json)
         return nbytes, Metadata({'content-type': 'application/json'}), body
 
     def __getitem__(self, k):
@@ -121,8 +131,18 @@ class ACLs (dict):
         dict.__setitem__(self, k, v)
         v.resource = self.resource
         v.access = k
+        self._json = None
+
+def uri_list_body(uris, batch=1000):
+    """Generate text/uri-list body chunks of up to batch lines each.
+
+       This spares joining and encoding a large listing into a single
+       contiguous copy before any of it is sent.
+    """
+    for i in range(0, len(uris), batch):
+        yield ''.join([ uri + '\n' for uri in uris[i:i+batch] ]).encode()
 
-def negotiated_uri_list(parent, resources, metadata={}):
+def negotiated_uri_list(parent, uris, metadata={}):
     """Returns nbytes, Metadata, body"""
     metadata = dict(metadata)
     metadata['content-type'] = negotiated_content_type(
@@ -130,9 +150,10 @@ def negotiated_uri_list(parent, resources, metadata={}):
         ['application/json', 'text/uri-list', 'text/html'],
         'application/json'
     )
-    uris = [r.asurl() for r in resources]
     if metadata['content-type'] == 'text/uri-list':
-        body = '\n'.join(uris) + '\n'
+        # the length is summed up front so the batched body keeps its Content-Length
+        nbytes = sum([ len(uri.encode()) + 1 for uri in uris ])
+        return nbytes, Metadata(metadata), uri_list_body(uris)
     elif metadata['content-type'] == 'text/html':
         body = "<!DOCTYPE html>\n<html>\n  <h1>Index of {parent}</h1>\n{children}\n</html>".format(
             parent=html.escape(parent.asurl()),
@@ -140,31 +161,45 @@ def negotiated_uri_list(parent, resources, metadata={}):
                 '  <a href="%s">%s</a>' % (html.escape(uri), html.escape(os.path.basename(uri)))
                 for uri in uris
             ])
-        )
+        ).encode()
     else:
-        body = jsonWriter(uris) + b'\n'
+        nbytes, body = json_body(uris)
         metadata['content-type'] = 'application/json'
+        return nbytes, Metadata(metadata), body
     return len(body), Metadata(metadata), body
 
 class HatracName (object):
     """Represent a bound name."""
+    __slots__ = ('directory', 'id', 'ancestors', 'pid', 'name', 'is_deleted', 'metadata', '_acl_sets', '_public_accesses', '_acl_grants', '_acls')
+
     _acl_names = []
     _ancestor_acl_names = []
     _table_name = 'name'
 
     def __init__(self, directory, **args):
+        self._bind(
+            directory, args['id'], args['pid'], args['ancestors'], args['name'],
+            args.get('is_deleted'), args.get('metadata', {})
+        )
+        if 'owner' in args:
+            self._acl_load(**args)
+
+    def _bind(self, directory, id, pid, ancestors, name, is_deleted, metadata):
         self.directory = directory
-        self.id = args['id']
-        self.ancestors = args['ancestors']
-        self.pid = args['pid']
-        self.name = args['name']
-        self.is_deleted = args.get('is_deleted')
-        self.metadata = Metadata(args.get('metadata', {}))
+        self.id = id
+        self.ancestors = ancestors
+        self.pid = pid
+        self.name = name
+        self.is_deleted = is_deleted
+        if not isinstance(metadata, Metadata):
+            # rows decoded by Metadata.from_sql are already fresh instances
+            metadata = Metadata(metadata)
+        self.metadata = metadata
         self.metadata.resource = self
-        self.acls = ACLs()
-        self.acls.directory = directory
-        self.acls.resource = self
-        self._acl_load(**args)
+        self._acl_sets = None
+        self._public_accesses = None
+        self._acl_grants = None
+        self._acls = None
 
     @staticmethod
     def construct(directory, **args):
@@ -173,17 +208,67 @@ class HatracName (object):
             HatracObject
         ][args['subtype']](directory, **args)
 
+    @staticmethod
+    def construct_rows(directory, rows):
+        """Construct identity-only names from (id, pid, ancestors, name, subtype, is_deleted) tuples.
+
+           Skips the per-row keyword packing of construct() for bulk
+           enumerations; ACLs stay deferred as for any identity-only row.
+        """
+        classes = (HatracNamespace, HatracObject)
+        results = []
+        for id, pid, ancestors, name, subtype, is_deleted in rows:
+            resource = object.__new__(classes[subtype])
+            resource._bind(directory, id, pid, ancestors, name, is_deleted, {})
+            results.append(resource)
+        return results
+
     def __str__(self):
         return self.directory.prefix + self.name
 
     def asurl(self):
         return self.directory.prefix + self.name
 
+    @property
+    def acl_sets(self):
+        """Map each ACL name to a frozenset of roles for access checks."""
+        if self._acl_sets is None:
+            # identity-only rows from bulk enumeration defer ACL columns until needed;
+            # directory methods load them on their own transaction first, so this
+            # separate lookup only serves checks made outside any transaction
+            self._acl_load(**self.directory.name_acls_lookup(self))
+        return self._acl_sets
+
+    @property
+    def acls(self):
+        """ACL sub-resources, built on demand from acl_sets for the ACL REST API."""
+        if self._acls is None:
+            acls = ACLs()
+            acls.directory = self.directory
+            acls.resource = self
+            for an, roles in self.acl_sets.items():
+                acls[an] = ACL(roles)
+            self._acls = acls
+        return self._acls
+
     def _acl_load(self, **args):
-        for an in self._acl_names:
-            self.acls[an] = ACL(coalesce(args.get('%s' % an), []))
-        for an in self._ancestor_acl_names:
-            self.acls[an] = ACL(coalesce(args.get('%s' % an), []))
+        self._acl_sets = {
+            an: frozenset(args[an]) if args.get(an) else _EMPTY
+            for names in (self._acl_names, self._ancestor_acl_names)
+            for an in names
+        }
+        self._acl_changed()
+
+    def _acl_replace(self, access, roles):
+        """Replace one locally held ACL after the directory stored it."""
+        self.acl_sets[access] = frozenset(roles)
+        self._acl_changed()
+
+    def _acl_changed(self):
+        # ACLs granting '*' let enforce_acl skip the union and client attributes
+        self._public_accesses = frozenset([ an for an, roles in self._acl_sets.items() if '*' in roles ])
+        self._acl_grants = None
+        self._acls = None
 
     def get_acl(self, access):
         return list(self.acls[access])
@@ -204,13 +289,22 @@ class HatracName (object):
         raise NotImplementedError()
 
     def enforce_acl(self, accesses, client_context=None):
+        acl_sets = self.acl_sets
+        if not self._public_accesses.isdisjoint(accesses):
+            return True
         if client_context is None:
             client_context = hatrac_ctx.webauthn2_context
+        # repeat checks within one request reuse the earlier grant
+        key = tuple(accesses)
+        grants = self._acl_grants
+        if grants is not None and grants.get(key) is client_context:
+            return True
+        acl = _EMPTY.union(*[acl_sets.get(access, _EMPTY) for access in accesses])
         core.set_acl_match_attributes(client_context)
-        acl = set()
-        for access in accesses:
-            acl.update( self.acls.get(access, ACL()))
         if not acl.isdisjoint(client_context.acl_match_attributes):
+            if grants is None:
+                grants = self._acl_grants = dict()
+            grants[key] = client_context
             return True
         elif client_context.client is not None:
             raise core.Forbidden('Access to %s forbidden.' % self)
@@ -241,6 +335,8 @@ class HatracName (object):
 
 class HatracNamespace (HatracName):
     """Represent a bound namespace."""
+    __slots__ = ()
+
     _acl_names = ['owner', 'create', 'read', 'subtree-owner', 'subtree-create', 'subtree-read', 'subtree-update']
     _ancestor_acl_names = ['ancestor_owner', 'ancestor_create', 'ancestor_read']
 
@@ -259,10 +355,12 @@ class HatracNamespace (HatracName):
     def get_content(self, client_context, get_data=True):
         """Return (nbytes, metadata, data_generator) for namespace."""
         self.enforce_acl(['owner', 'read', 'ancestor_owner', 'ancestor_read'], client_context)
-        return negotiated_uri_list(self, self.directory.namespace_enumerate_names(self, False))
+        return negotiated_uri_list(self, self.directory.namespace_enumerate_name_strings(self, False))
 
 class HatracObject (HatracName):
     """Represent a bound object."""
+    __slots__ = ()
+
     _acl_names = ['owner', 'update', 'read', 'subtree-owner', 'subtree-read']
     _ancestor_acl_names = ['ancestor_owner', 'ancestor_update', 'ancestor_read']
 
@@ -313,6 +411,8 @@ class HatracObject (HatracName):
         return self.directory.upload_resolve(self, upload)
 
 class HatracVersions (object):
+    __slots__ = ('object',)
+
     def is_object(self):
         return False
 
@@ -324,10 +424,12 @@ class HatracVersions (object):
 
     def get_content(self, client_context, get_data=True):
         self.object.enforce_acl(['owner', 'ancestor_owner', 'read', 'ancestor_read'], client_context)
-        return negotiated_uri_list(self, self.object.directory.object_enumerate_versions(self.object))
+        return negotiated_uri_list(self, self.object.directory.object_enumerate_version_strings(self.object))
 
 class HatracObjectVersion (HatracName):
     """Represent a bound object version."""
+    __slots__ = ('object', 'version', 'nbytes', 'aux')
+
     _acl_names = ['owner', 'read']
     # we pull in the object's subtree-* ACLs and treat them like ancestor ACLs
     # since ancestor ACLs only roll up the ancestor namespaces but not the object itself
@@ -375,6 +477,8 @@ class HatracObjectVersion (HatracName):
         return self.directory.delete_version(self, client_context)
 
 class HatracUploads (object):
+    __slots__ = ('object',)
+
     def is_object(self):
         return False
 
@@ -389,10 +493,12 @@ class HatracUploads (object):
 
     def get_content(self, client_context, get_data=True):
         self.object.enforce_acl(['owner'], client_context)
-        return negotiated_uri_list(self, self.object.directory.namespace_enumerate_uploads(self.object))
+        return negotiated_uri_list(self, [ r.asurl() for r in self.object.directory.namespace_enumerate_uploads(self.object) ])
 
 class HatracUpload (HatracName):
     """Represent an upload job."""
+    __slots__ = ('object', 'nameid', 'job', 'nbytes', 'chunksize', 'created_on', 'nchunks', 'remainder')
+
     _acl_names = ['owner']
     _ancestor_acl_names = ['ancestor_owner']
     _table_name = 'upload'
@@ -408,6 +514,8 @@ class HatracUpload (HatracName):
         self.nbytes = args['nbytes']
         self.chunksize = args['chunksize']
         self.created_on = args['created_on']
+        # nchunks full-size chunks, plus one final chunk of remainder bytes if non-zero
+        self.nchunks, self.remainder = divmod(self.nbytes or 0, self.chunksize)
 
     def __str__(self):
         return "%s;upload/%s" % (self.object, self.job)
@@ -436,8 +544,8 @@ class HatracUpload (HatracName):
         }:
             if hdr in metadata:
                 body[hdr] = metadata[hdr]
-        body = jsonWriter(body) + b'\n'
-        return len(body), Metadata({'content-type': 'application/json'}), body
+        nbytes, body = json_body(body)
+        return nbytes, Metadata({'content-type': 'application/json'}), body
 
     def finalize(self, client_context):
         return self.directory.upload_finalize(self, client_context)
@@ -457,137 +565,15 @@ class connection (psycopg2.extensions.connection):
             self.rollback()
 
     def _prepare_hatrac_stmts(self):
+        stmts = _prepare_hatrac_stmts_sql
         cur = self.cursor()
-        cur.execute("""
-        
-        DEALLOCATE PREPARE ALL;
-
-        PREPARE hatrac_complete_version (int8, text, boolean) AS 
-          UPDATE hatrac.version  SET is_deleted = $3, version = $2  WHERE id = $1 ;
-
-        PREPARE hatrac_delete_version (int8) AS
-          UPDATE hatrac.version  SET is_deleted = True  WHERE id = $1 ;
-
-        PREPARE hatrac_delete_name (int8) AS
-          UPDATE hatrac.name  SET is_deleted = True  WHERE id = $1 ;
-
-        PREPARE hatrac_delete_chunks (int8) AS
-          DELETE FROM hatrac.chunk WHERE uploadid = $1 ;
-
-        PREPARE hatrac_delete_upload (int8) AS
-          DELETE FROM hatrac.upload WHERE id = $1 ;
-        
-        PREPARE hatrac_name_lookup (text, boolean) AS
-          SELECT n.*, %(owner_acl)s, %(update_acl)s, %(read_acl)s, %(create_acl)s
-          FROM hatrac.name n
-          WHERE n.name = $1 AND (NOT n.is_deleted OR NOT $2) ;
-
-        PREPARE hatrac_version_lookup (int8, text) AS
-          SELECT v.*, n.name, n.pid, n.ancestors, n."subtree-owner", n."subtree-read", %(owner_acl)s, %(read_acl)s
-          FROM hatrac.version v
-          JOIN hatrac.name n ON (v.nameid = n.id)
-          WHERE v.nameid = $1 AND v.version = $2 ;
-
-        PREPARE hatrac_upload_lookup(int8, text) AS
-          SELECT u.*, n.name, n.pid, n.ancestors, %(owner_acl)s
-          FROM hatrac.upload u
-          JOIN hatrac.name n ON (u.nameid = n.id)
-          WHERE u.nameid = $1 AND u.job = $2 ;
-
-        PREPARE hatrac_version_list(int8, int8) AS
-          SELECT v.*, n.name, n.pid, n.ancestors
-          FROM hatrac.name n
-          JOIN hatrac.version v ON (v.nameid = n.id)
-          WHERE v.nameid = $1 AND NOT v.is_deleted 
-          ORDER BY v.id DESC
-          LIMIT $2 ;
-
-        PREPARE hatrac_chunk_list (int8, int8) AS
-          SELECT *
-          FROM hatrac.chunk
-          WHERE uploadid = $1 AND ($2 IS NULL OR position = $2)
-          ORDER BY position ;
-
-        PREPARE hatrac_object_enumerate_versions (int8) AS
-          SELECT n.name, n.pid, n.ancestors, n.subtype, n.update, n."subtree-owner", n."subtree-read", v.*, %(owner_acl)s, %(read_acl)s
-          FROM hatrac.name n
-          JOIN hatrac.version v ON (v.nameid = n.id)
-          WHERE v.nameid = $1 AND NOT v.is_deleted
-          ORDER BY n.id, v.id ;
-
-        PREPARE hatrac_namepattern_enumerate_versions (text) AS
-          SELECT n.name, n.pid, n.ancestors, n.subtype, n.update, n."subtree-owner", n."subtree-read", v.*, %(owner_acl)s, %(read_acl)s
-          FROM hatrac.name n
-          JOIN hatrac.version v ON (v.nameid = n.id)
-          WHERE n.name ~ $1 AND NOT v.is_deleted
-          ORDER BY n.name, v.id ;
-
-        PREPARE hatrac_namespace_children_noacl (int8) AS
-          SELECT n.*
-          FROM hatrac.name p
-          JOIN hatrac.name n ON (n.pid = p.id)
-          WHERE p.id = $1 AND NOT n.is_deleted
-          ORDER BY n.name ;
-
-        PREPARE hatrac_namespace_children_acl (int8) AS
-          SELECT n.*, %(owner_acl)s, %(update_acl)s, %(read_acl)s, %(create_acl)s
-          FROM hatrac.name p
-          JOIN hatrac.name n ON (n.pid = p.id)
-          WHERE p.id = $1 AND NOT n.is_deleted
-          ORDER BY n.name ;
-
-        PREPARE hatrac_namespace_subtree_noacl (int8) AS
-          SELECT n.*
-          FROM hatrac.name p
-          JOIN hatrac.name n ON (p.id = ANY( n.ancestors ))
-          WHERE p.id = $1 AND NOT n.is_deleted
-          ORDER BY n.name ;
-
-        PREPARE hatrac_namespace_subtree_acl (int8) AS
-          SELECT n.*, %(owner_acl)s, %(update_acl)s, %(read_acl)s, %(create_acl)s
-          FROM hatrac.name p
-          JOIN hatrac.name n ON (p.id = ANY( n.ancestors ))
-          WHERE p.id = $1 AND NOT n.is_deleted
-          ORDER BY n.name ;
-
-        PREPARE hatrac_object_uploads (int8) AS 
-          SELECT u.*, n.name, n.pid, n.ancestors, %(owner_acl)s
-          FROM hatrac.name n
-          JOIN hatrac.upload u ON (u.nameid = n.id)
-          WHERE n.id = $1
-          ORDER BY u.id ;
-
-        PREPARE hatrac_namespace_uploads (int8) AS
-          SELECT u.*, n.name, n.pid, n.ancestors, %(owner_acl)s
-          FROM hatrac.name n
-          JOIN hatrac.upload u ON (u.nameid = n.id)
-          WHERE $1 = ANY (n.ancestors)
-          ORDER BY n.name, u.id ;
-
-        PREPARE hatrac_version_aux_url_update (int8, text) AS
-          UPDATE hatrac.version v 
-          SET aux = ('{"url":"' || $2 || '"}')::jsonb
-          WHERE id = $1 ;
-
-        PREPARE hatrac_version_aux_url_delete (int8) AS 
-          UPDATE hatrac.version
-          SET aux = aux::jsonb - 'url' 
-          WHERE id = $1 ;
-
-        PREPARE hatrac_version_aux_version_update (int8, text) AS 
-          UPDATE hatrac.version
-          SET aux = CASE WHEN $2 IS NOT NULL THEN 
-          ('{"version":"' || $2 || '"}')::jsonb ELSE aux::jsonb - 'version' END
-          WHERE id = $1 ;
-
-""" % dict(
-    owner_acl=ancestor_acl_sql('owner'),
-    update_acl=ancestor_acl_sql('update'),
-    read_acl=ancestor_acl_sql('read'),
-    create_acl=ancestor_acl_sql('create')
-)
-        )
-        
+        if core.config.get('database_plan_hints', False):
+            # pg_hint_plan only honors a hint leading the submitted query text
+            for stmt in stmts:
+                cur.execute(stmt)
+        else:
+            # otherwise send every PREPARE in one simple-query round trip
+            cur.execute(''.join(stmts))
         cur.close()
         self.commit()
 
@@ -595,8 +581,17 @@ def pool(minconn, maxconn, dsn):
     """Open a thread-safe connection pool with minconn <= N <= maxconn connections to database.
 
        The connections are from the customized connection factory in this module.
+
+       The pool keeps up to minconn idle connections open between
+       requests, closing surplus ones when they are returned, so
+       minconn should cover the usual request concurrency.  TCP
+       keepalives stop idle pooled sessions being silently dropped.
     """
-    return psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn=dsn, connection_factory=connection, cursor_factory=DictCursor)
+    return psycopg2.pool.ThreadedConnectionPool(
+        minconn, maxconn, dsn=dsn,
+        connection_factory=connection, cursor_factory=DictCursor,
+        keepalives=1, keepalives_idle=60,
+    )
 
 class PoolManager (object):
     """Manage a set of database connection pools keyed by database name.
@@ -606,6 +601,32 @@ class PoolManager (object):
         # map dsn -> [pool, timestamp]
         self.pools = dict()
         self.max_idle_seconds = 60 * 60 # 1 hour
+        # close old pools off the request path so lookup stays O(1), but only once
+        # a pool exists, so merely importing this module starts no thread
+        self._reaper = None
+        self._reaper_lock = threading.Lock()
+
+    def _start_reaper(self):
+        with self._reaper_lock:
+            # a forked child inherits the reaper object but not its thread
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._reap, name='hatrac-pool-reaper', daemon=True)
+                self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.max_idle_seconds // 10)
+            self._sweep()
+
+    def _sweep(self):
+        """Close and drop pools idle longer than max_idle_seconds."""
+        now = time.monotonic()
+        for key, pair in list(self.pools.items()):
+            if (now - pair[1]) >= self.max_idle_seconds:
+                # only drop the exact pair we judged idle
+                if self.pools.get(key) is pair:
+                    self.pools.pop(key, None)
+                    pair[0].closeall()
 
     def __getitem__(self, dsn):
         """Lookup existing or create new pool for database on demand.
@@ -613,53 +634,51 @@ class PoolManager (object):
            May fail transiently and caller should retry.
 
         """
-        # abandon old pools so they can be garbage collected
-        for key in list(self.pools.keys()):
-            try:
-                pair = self.pools.pop(key)
-                delta = (datetime.datetime.now() - pair[1])
-                try:
-                    delta_seconds = delta.total_seconds()
-                except:
-                    delta_seconds = delta.seconds + delta.microseconds * math.pow(10,-6)
-                    
-                if delta_seconds < self.max_idle_seconds:
-                    # this pool is sufficiently active so put it back!
-                    boundpair = self.pools.setdefault(key, pair)
-                # if pair is still removed at this point, let garbage collector deal with it
-            except KeyError:
-                # another thread could have purged key before we got to it
-                pass
-
-        try:
-            pair = self.pools[dsn]
-            pair[1] = datetime.datetime.now() # update timestamp
+        pair = self.pools.get(dsn)
+        if pair is not None:
+            pair[1] = time.monotonic() # update timestamp
             return pair[0]
-        except KeyError:
-            # atomically get/set pool
-            newpool = pool(1, 4, dsn)
-            boundpair = self.pools.setdefault(dsn, [newpool, datetime.datetime.now()])
-            if boundpair[0] is not newpool:
-                # someone beat us to it
-                newpool.closeall()
-            return boundpair[0]
-            
+        # atomically get/set pool
+        newpool = pool(
+            core.config.get('database_pool_min', 1),
+            core.config.get('database_pool_max', 32),
+            dsn
+        )
+        boundpair = self.pools.setdefault(dsn, [newpool, time.monotonic()])
+        if boundpair[0] is not newpool:
+            # someone beat us to it
+            newpool.closeall()
+        self._start_reaper()
+        return boundpair[0]
+
 pools = PoolManager()       
 
 class PooledConnection (object):
     def __init__(self, dsn):
         self.dsn = dsn
 
-    def perform(self, bodyfunc, finalfunc=lambda x: x, verbose=False):
+    def perform(self, bodyfunc, finalfunc=lambda x: x, verbose=False, readonly=False, isolation=None):
         """Run bodyfunc(conn, cur) using pooling, commit, transform with finalfunc, clean up.
         
            Automates handling of errors.
+
+           With readonly=True, bodyfunc runs in a READ ONLY, READ
+           COMMITTED transaction, which suffices for idempotent lookups.
+           Otherwise it runs at the given isolation level, by default
+           REPEATABLE READ.
         """
         used_pool = pools[self.dsn]
         conn = used_pool.getconn()
         assert conn is not None
         assert conn.status == psycopg2.extensions.STATUS_READY, ("pooled connection status", conn.status)
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        # session settings persist on pooled connections so always set both
+        if readonly:
+            conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED, readonly=True)
+        else:
+            conn.set_session(
+                isolation_level=isolation or psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+                readonly=False
+            )
         cur = conn.cursor(cursor_factory=DictCursor)
 
         try:
@@ -709,6 +728,7 @@ CREATE TABLE IF NOT EXISTS hatrac.name (
 );
 
 CREATE INDEX IF NOT EXISTS name_ancestors_idx ON hatrac."name" USING gin (ancestors) WHERE NOT is_deleted;
+CREATE INDEX IF NOT EXISTS name_pid_idx ON hatrac."name" (pid) WHERE NOT is_deleted;
 CREATE INDEX IF NOT EXISTS name_id_idx ON hatrac."name" (id) WHERE "subtree-owner" IS NOT NULL;
 CREATE INDEX IF NOT EXISTS name_id_idx1 ON hatrac."name" (id) WHERE "subtree-create" IS NOT NULL;
 CREATE INDEX IF NOT EXISTS name_id_idx2 ON hatrac."name" (id) WHERE "subtree-read" IS NOT NULL;
@@ -736,6 +756,7 @@ CREATE TABLE IF NOT EXISTS hatrac.version (
 );
 
 CREATE INDEX IF NOT EXISTS version_nameid_id_idx ON hatrac.version (nameid, id);
+CREATE INDEX IF NOT EXISTS version_live_idx ON hatrac.version (nameid, id DESC) WHERE NOT is_deleted;
 
 DO $aux_upgrade$
 BEGIN
@@ -788,13 +809,18 @@ CREATE TABLE IF NOT EXISTS hatrac.chunk (
 );
 """
 
-def db_wrap(transform=lambda x: x, enforce_acl=None):
+def db_wrap(transform=lambda x: x, enforce_acl=None, readonly=False, isolation=None):
     """Decorate a HatracDirectory method whose body should run in pc.perform(...)
 
        If enforce_acl is (rpos, cpos, acls):
           call args[rpos].enforce_acl(acls, args[cpos])
 
        Transform result as transform(result).
+
+       If readonly, the body only reads and runs in a read-only transaction.
+
+       If isolation is given, a writing body runs at that isolation
+       level rather than REPEATABLE READ.
     """
     def helper(original_method):
         def wrapper(*args, **kwargs):
@@ -803,6 +829,8 @@ def db_wrap(transform=lambda x: x, enforce_acl=None):
                 kwargs1 = dict(kwargs)
                 if enforce_acl is not None:
                     rpos, cpos, acls = enforce_acl
+                    # deferred ACLs load on this transaction rather than a second pooled one
+                    args[0]._acl_ensure(conn, cur, args1[rpos])
                     args1[rpos].enforce_acl(acls, args[cpos])
                 kwargs1['conn'] = conn
                 kwargs1['cur'] = cur
@@ -813,42 +841,371 @@ def db_wrap(transform=lambda x: x, enforce_acl=None):
                 # allow nested calls to db-wrapped functions to run in same outer transaction
                 return transform(db_thunk(conn, cur))
             else:
-                return args[0].pc.perform(db_thunk, transform)
+                return args[0].pc.perform(db_thunk, transform, readonly=readonly, isolation=isolation)
         return wrapper
     return helper
 
-def ancestor_acl_sql(access):
-    """Generate SQL subqueries to compute ancestor ACL arrays for listed accesses.
-  
-       The SQL fragments are scalar subqueries with an alias:
+def plan_hint(hint):
+    """Return a pg_hint_plan comment prefix for hint, or '' unless database_plan_hints is configured.
 
-         (SELECT array_agg(...) ... WHERE n.name = ...) AS "ancestor_access"  
+       The comment must lead the statement text for pg_hint_plan to
+       read it, and is ignored by servers without the extension.
+    """
+    if core.config.get('database_plan_hints', False):
+        return '/*+ %s */ ' % hint
+    return ''
 
-       suitable for inclusion in a SQL SELECT clause.  This SQL
-       expects the table alias "n" to be bound to the "name" table
-       instance for which ancestor ACLs are being constructed.
+def ancestor_acls_sql(accesses):
+    """Generate a SQL lateral join to compute ancestor ACL arrays for listed accesses.
+
+       The SQL fragment joins one row aliased "acl" with a column per
+       access:
+
+         LEFT JOIN LATERAL (SELECT array_agg(...) AS "ancestor_access", ...) acl ON (True)
+
+       suitable for inclusion after a FROM item.  All arrays are
+       aggregated in one pass over the ancestor rows, unnesting their
+       subtree ACL columns side by side.  This SQL expects the table
+       alias "n" to be bound to the "name" table instance for which
+       ancestor ACLs are being constructed.
 
     """
+    slots = [ 'r%d' % i for i in range(len(accesses)) ]
     return '''
-(SELECT array_agg(DISTINCT s.r)
- FROM (SELECT unnest(%(aclcol)s) AS r
-       FROM hatrac.name a
-       WHERE a.id = ANY ( n.ancestors )
-         AND a.%(aclcol)s IS NOT NULL
- ) s
-) AS %(acl)s''' % dict(
-    aclcol=sql_identifier('subtree-%s' % access),
-    acl=sql_identifier('ancestor_%s' % access)
+LEFT JOIN LATERAL (
+  SELECT %(aggs)s
+  FROM hatrac.name a,
+       unnest(%(aclcols)s) AS s(%(slots)s)
+  WHERE a.id = ANY ( n.ancestors )
+) acl ON (True)''' % dict(
+    aggs=', '.join([
+        'array_agg(DISTINCT s.%s) FILTER (WHERE s.%s IS NOT NULL) AS %s' % (slot, slot, sql_identifier('ancestor_%s' % access))
+        for slot, access in zip(slots, accesses)
+    ]),
+    aclcols=', '.join([ 'a.%s' % sql_identifier('subtree-%s' % access) for access in accesses ]),
+    slots=', '.join(slots),
+)
+
+# ACL columns of each table, which ACL update statements choose among by name
+_acl_columns = {
+    'name': ['owner', 'create', 'update', 'read', 'subtree-owner', 'subtree-create', 'subtree-read', 'subtree-update'],
+    'version': ['owner', 'read'],
+    'upload': ['owner'],
+}
+
+def acl_update_sql():
+    """Generate PREPARE texts to add, drop, or set roles in one named ACL column.
+
+       For each table there is a hatrac_acl_<op>_<table> statement:
+
+         add (id int8, access text, role text)
+         drop (id int8, access text, role text)
+         set (id int8, access text, roles text[])
+
+       Identifiers cannot be parameters, so each statement assigns
+       every ACL column of its table and only changes the column
+       whose name matches the access parameter.
+    """
+    ops = {
+        'add': ('text', 'CASE WHEN $3 = ANY (coalesce(n.%(acl)s, ARRAY[]::text[])) THEN n.%(acl)s'
+                ' ELSE array_append(coalesce(n.%(acl)s, ARRAY[]::text[]), $3) END'),
+        'drop': ('text', 'array_remove(n.%(acl)s, $3)'),
+        'set': ('text[]', '$3'),
+    }
+    return [
+        """
+    PREPARE hatrac_acl_%(op)s_%(table)s (int8, text, %(rtype)s) AS
+      UPDATE hatrac.%(table)s n
+      SET %(assigns)s
+      WHERE n.id = $1 ;
+""" % dict(
+    op=op,
+    table=table,
+    rtype=rtype,
+    assigns=',\n          '.join([
+        '%(acl)s = CASE WHEN $2 = %(name)s THEN %(expr)s ELSE n.%(acl)s END' % dict(
+            acl=sql_identifier(acl),
+            name=sql_literal(acl),
+            expr=expr % dict(acl=sql_identifier(acl)),
+        )
+        for acl in acls
+    ])
 )
+        for table, acls in _acl_columns.items()
+        for op, (rtype, expr) in ops.items()
+    ]
+
+def _prepare_hatrac_sql():
+    """Return the list of PREPARE texts run on each new pooled connection."""
+    stmts = []
+    stmts.append("""
+    
+    DEALLOCATE PREPARE ALL;
+
+    PREPARE hatrac_create_name (text, int8, int8[], int4, text[]) AS
+      INSERT INTO hatrac.name (name, pid, ancestors, subtype, is_deleted, owner)
+      VALUES ($1, $2, $3, $4, False, $5)
+      RETURNING * ;
+
+    PREPARE hatrac_create_version (int8, text, int8, jsonb, boolean, text[]) AS
+      INSERT INTO hatrac.version (nameid, version, nbytes, metadata, is_deleted, owner)
+      VALUES ($1, $2, $3, $4, $5, $6)
+      RETURNING * ;
+
+    PREPARE hatrac_create_upload (int8, text, int8, int8, jsonb, text[]) AS
+      INSERT INTO hatrac.upload (nameid, job, nbytes, chunksize, metadata, owner)
+      VALUES ($1, $2, $3, $4, $5, $6)
+      RETURNING * ;
+
+    PREPARE hatrac_metadata_set_version (int8, jsonb) AS
+      UPDATE hatrac.version  SET metadata = $2  WHERE id = $1 ;
+
+    PREPARE hatrac_metadata_set_upload (int8, jsonb) AS
+      UPDATE hatrac.upload  SET metadata = $2  WHERE id = $1 ;
+
+    PREPARE hatrac_complete_version (int8, text, boolean) AS 
+      UPDATE hatrac.version  SET is_deleted = $3, version = $2  WHERE id = $1 ;
+
+    PREPARE hatrac_delete_version (int8) AS
+      UPDATE hatrac.version  SET is_deleted = True  WHERE id = $1 AND NOT is_deleted  RETURNING id ;
+
+    PREPARE hatrac_delete_name (int8) AS
+      UPDATE hatrac.name  SET is_deleted = True  WHERE id = $1 AND NOT is_deleted  RETURNING id ;
+
+    PREPARE hatrac_delete_chunks (int8) AS
+      DELETE FROM hatrac.chunk WHERE uploadid = $1 ;
+
+    PREPARE hatrac_delete_upload (int8) AS
+      DELETE FROM hatrac.upload WHERE id = $1  RETURNING id ;
+
+    PREPARE hatrac_delete_versions (int8[]) AS
+      UPDATE hatrac.version  SET is_deleted = True  WHERE id = ANY($1) ;
+
+    PREPARE hatrac_delete_names (int8[]) AS
+      UPDATE hatrac.name  SET is_deleted = True  WHERE id = ANY($1) AND NOT is_deleted  RETURNING id ;
+
+    PREPARE hatrac_delete_uploads_chunks (int8[]) AS
+      DELETE FROM hatrac.chunk WHERE uploadid = ANY($1) ;
+
+    PREPARE hatrac_delete_uploads (int8[]) AS
+      DELETE FROM hatrac.upload WHERE id = ANY($1) ;
+    
+    PREPARE hatrac_version_lookup (int8, text) AS
+      SELECT v.*
+      FROM hatrac.version v
+      WHERE v.nameid = $1 AND v.version = $2 ;
+
+    PREPARE hatrac_upload_lookup(int8, text) AS
+      SELECT u.*
+      FROM hatrac.upload u
+      WHERE u.nameid = $1 AND u.job = $2 ;
+
+    PREPARE hatrac_upload_claim (int8) AS
+      SELECT u.id
+      FROM hatrac.upload u
+      WHERE u.id = $1
+      FOR NO KEY UPDATE SKIP LOCKED ;
+
+    PREPARE hatrac_upload_exists (int8) AS
+      SELECT u.id
+      FROM hatrac.upload u
+      WHERE u.id = $1 ;
+
+    PREPARE hatrac_track_chunk (int8, int8, json) AS
+      INSERT INTO hatrac.chunk (uploadid, position, aux)
+      VALUES ($1, $2, $3)
+      ON CONFLICT (uploadid, position) DO UPDATE SET aux = EXCLUDED.aux ;
+
+    PREPARE hatrac_chunk_list (int8) AS
+      SELECT uploadid, position, aux
+      FROM hatrac.chunk
+      WHERE uploadid = $1
+      ORDER BY position ;
+
+    PREPARE hatrac_chunk_get (int8, int8) AS
+      SELECT uploadid, position, aux
+      FROM hatrac.chunk
+      WHERE uploadid = $1 AND position = $2 ;
+
+    PREPARE hatrac_delete_plan (int8) AS
+      SELECT 'upload' AS kind, u.id, n.name, NULL::text AS version, u.job, NULL::json AS aux,
+        NULL::text[] AS owner, NULL::text[] AS "subtree-owner", NULL::text[] AS ancestor_owner
+      FROM hatrac.name n
+      JOIN hatrac.upload u ON (u.nameid = n.id)
+      WHERE n.id = $1
+      UNION ALL
+      SELECT 'upload', u.id, n.name, NULL, u.job, NULL, NULL, NULL, NULL
+      FROM hatrac.name n
+      JOIN hatrac.upload u ON (u.nameid = n.id)
+      WHERE n.ancestors @> ARRAY[$1] AND NOT n.is_deleted
+      UNION ALL
+      SELECT 'version', v.id, n.name, v.version, NULL, v.aux, v.owner, n."subtree-owner", acl.ancestor_owner
+      FROM hatrac.name n
+      JOIN hatrac.version v ON (v.nameid = n.id)
+      %(owner_acl)s
+      WHERE v.nameid = $1 AND NOT v.is_deleted
+      UNION ALL
+      SELECT 'version', v.id, n.name, v.version, NULL, v.aux, v.owner, n."subtree-owner", acl.ancestor_owner
+      FROM hatrac.name n
+      JOIN hatrac.version v ON (v.nameid = n.id)
+      %(owner_acl)s
+      WHERE n.ancestors @> ARRAY[$1] AND NOT n.is_deleted AND NOT v.is_deleted
+      UNION ALL
+      SELECT 'name', n.id, n.name, NULL, NULL, NULL, n.owner, NULL, acl.ancestor_owner
+      FROM hatrac.name n
+      %(owner_acl)s
+      WHERE n.ancestors @> ARRAY[$1] AND NOT n.is_deleted
+      ORDER BY kind, name, id ;
+
+    PREPARE hatrac_namespace_children_acl (int8) AS
+      SELECT n.*, acl.*
+      FROM hatrac.name n
+      %(acls)s
+      WHERE n.pid = $1 AND NOT n.is_deleted
+      ORDER BY n.name ;
+
+    PREPARE hatrac_namespace_subtree_acl (int8) AS
+      SELECT n.*, acl.*
+      FROM hatrac.name n
+      %(acls)s
+      WHERE n.ancestors @> ARRAY[$1] AND NOT n.is_deleted
+      ORDER BY n.name ;
+
+    PREPARE hatrac_version_aux_url_update (int8, text) AS
+      UPDATE hatrac.version v 
+      SET aux = ('{"url":"' || $2 || '"}')::jsonb
+      WHERE id = $1 ;
+
+    PREPARE hatrac_version_aux_url_delete (int8) AS 
+      UPDATE hatrac.version
+      SET aux = aux::jsonb - 'url' 
+      WHERE id = $1 ;
+
+    PREPARE hatrac_version_aux_version_update (int8, text) AS 
+      UPDATE hatrac.version
+      SET aux = CASE WHEN $2 IS NOT NULL THEN 
+      ('{"version":"' || $2 || '"}')::jsonb ELSE aux::jsonb - 'version' END
+      WHERE id = $1 ;
+
+""" % dict(
+    owner_acl=ancestor_acls_sql(['owner']),
+    acls=ancestor_acls_sql(['owner', 'update', 'read', 'create']),
+    )
+    )
+
+    # hot lookups are separate texts so an optional leading plan hint applies to each
+    stmts.append(plan_hint('IndexScan(n name_name_key)') + """
+    PREPARE hatrac_name_lookup (text, boolean) AS
+      SELECT n.*, acl.*
+      FROM hatrac.name n
+      %(acls)s
+      WHERE n.name = $1 AND (NOT n.is_deleted OR NOT $2) ;
+""" % dict(
+    acls=ancestor_acls_sql(['owner', 'update', 'read', 'create']),
+    )
+    )
+    stmts.append(plan_hint('IndexScan(n name_name_key)') + """
+    PREPARE hatrac_name_lookup_many (text[]) AS
+      SELECT n.*, acl.*
+      FROM hatrac.name n
+      %(acls)s
+      WHERE n.name = ANY ($1) ;
+""" % dict(
+    acls=ancestor_acls_sql(['owner', 'update', 'read', 'create']),
+    )
+    )
+    # first and later keyset pages are separate statements so the id bound
+    # stays a plain index condition in the generic plan
+    stmts.append(plan_hint('IndexScan(v version_live_idx)') + """
+    PREPARE hatrac_version_list_first (int8, int8) AS
+      SELECT v.*
+      FROM hatrac.version v
+      WHERE v.nameid = $1 AND NOT v.is_deleted
+      ORDER BY v.id DESC
+      LIMIT $2 ;
+""")
+    stmts.append(plan_hint('IndexScan(v version_live_idx)') + """
+    PREPARE hatrac_version_list_after (int8, int8, int8) AS
+      SELECT v.*
+      FROM hatrac.version v
+      WHERE v.nameid = $1 AND NOT v.is_deleted AND v.id < $3
+      ORDER BY v.id DESC
+      LIMIT $2 ;
+""")
+    stmts.append(plan_hint('IndexScan(v version_live_idx)') + """
+    PREPARE hatrac_version_current (int8) AS
+      SELECT v.*
+      FROM hatrac.version v
+      WHERE v.nameid = $1 AND NOT v.is_deleted
+      ORDER BY v.id DESC
+      LIMIT 1 ;
+""")
+    stmts.extend(acl_update_sql())
+    return stmts
+
+# interpolated once at import rather than per connection open
+_prepare_hatrac_stmts_sql = _prepare_hatrac_sql()
+
+_namespace_names_template = """
+SELECT %(columns)s
+FROM hatrac.name n
+WHERE %(scope)s AND NOT n.is_deleted
+ORDER BY n.name
+"""
+
+# column order of streamed name rows, which are fetched as plain tuples
+_namespace_names_columns = {
+    'rows': ('id', 'pid', 'ancestors', 'name', 'subtype', 'is_deleted'),
+    'names': ('name',),
+}
+
+# streamed name enumeration SQL keyed by (column set, scope), built once at import
+_namespace_names_sql = dict([
+    ((ckey, skey), _namespace_names_template % dict(
+        columns=', '.join([ 'n.%s' % c for c in columns ]),
+        scope=scope
+    ))
+    for ckey, columns in _namespace_names_columns.items()
+    for skey, scope in [
+            ('children', 'n.pid = %(id)s'),
+            ('subtree', 'n.ancestors @> ARRAY[%(id)s]::int8[]'),
+            ('root', 'n.pid IS NOT NULL'),
+    ]
+])
+
+_namespace_uploads_template = """
+SELECT u.*, n.name, n.pid, n.ancestors, acl.*
+FROM hatrac.name n
+JOIN hatrac.upload u ON (u.nameid = n.id)
+%(owner_acl)s
+WHERE %(scope)s
+ORDER BY n.name, u.id
+"""
+
+# streamed upload enumeration SQL keyed by resource kind, built once at import
+_namespace_uploads_sql = dict([
+    (kind, _namespace_uploads_template % dict(owner_acl=ancestor_acls_sql(['owner']), scope=scope))
+    for kind, scope in [
+            ('object', 'n.id = %(id)s'),
+            ('namespace', 'n.ancestors @> ARRAY[%(id)s]::int8[] AND NOT n.is_deleted'),
+    ]
+])
 
 class HatracDirectory (object):
     """Stateful Hatrac Directory tracks bound names and object versions.
 
     """
+    # rows per FETCH for server-side cursor enumerations
+    _stream_itersize = 1000
+
+    # object versions per storage.delete_many() call during delete cleanup
+    _storage_delete_batch = 1000
+
     def __init__(self, config, storage):
         self.storage = storage
         self.prefix = config.get('service_prefix')
         self.pc = PooledConnection(config.database_dsn)
+        self._storage_pool = ThreadPoolExecutor(max_workers=config.get('storage_workers', 8))
 
     @staticmethod
     def metadata_from_http(metadata):
@@ -870,25 +1227,23 @@ CREATE INDEX ON hatrac."name" (id) WHERE "subtree-create" IS NOT NULL;
 CREATE INDEX ON hatrac."name" (id) WHERE "subtree-read" IS NOT NULL;
 CREATE INDEX ON hatrac."name" (id) WHERE "subtree-update" IS NOT NULL;
 """)
+            # walk the tree from the root by parent name in one statement
+            # rather than one UPDATE round trip per level of depth
             cur.execute("""
-SELECT max( array_length(regexp_split_to_array(substring(n.name from 2), '/'), 1) ) maxdepth
-FROM name n
-WHERE id > 1;
-""")[0].maxdepth
-            maxdepth = cur.fetchone()[0]
-            
-            for i in range(maxdepth):
-                cur.execute("""
-UPDATE name n SET ancestors = a.ancestors || a.id
-FROM (
-  SELECT n2.id, regexp_split_to_array(substring(n2.name from 2), '/') as name_parts
-  FROM name n2
-) n2,
-name a
-WHERE n.id = n2.id
-  AND a.name = ('/' || array_to_string(n2.name_parts[1:array_length(n2.name_parts, 1)-1], '/'))
-  AND a.ancestors IS NOT NULL
-  AND n.id > 1
+WITH RECURSIVE walk(id, name, ancestors) AS (
+  SELECT n.id, n.name, ARRAY[]::int8[]
+  FROM hatrac."name" n
+  WHERE n.id = 1
+  UNION ALL
+  SELECT n.id, n.name, w.ancestors || w.id
+  FROM hatrac."name" n
+  JOIN walk w ON (w.name = coalesce(nullif(regexp_replace(n.name, '/[^/]+$', ''), ''), '/'))
+  WHERE n.id > 1
+)
+UPDATE hatrac."name" n SET ancestors = w.ancestors
+FROM walk w
+WHERE n.id = w.id
+  AND n.id > 1;
 """)
             sys.stderr.write('added ancestors column to name table\n')
 
@@ -898,47 +1253,53 @@ WHERE table_schema = 'hatrac' AND table_name = 'name' AND column_name = 'pid';
 """
         )
         if not cur.fetchone()[0]:
+            # ancestors is filled above, so the parent is its last element
+            # and no self-join over split name paths is needed
             cur.execute("""
 ALTER TABLE hatrac."name" ADD COLUMN "pid" int8 REFERENCES "name" (id);
-UPDATE hatrac."name" c SET pid = p.id
-FROM (
-  SELECT n2.id, regexp_split_to_array(substring(n2.name from 2), '/') as name_parts
-  FROM name n2
-) c2,
-name p
-WHERE c.id = c2.id
-  AND p.name = ('/' || array_to_string(c2.name_parts[1:array_length(c2.name_parts, 1)-1], '/'))
-;
+UPDATE hatrac."name" SET pid = ancestors[array_upper(ancestors, 1)]
+WHERE cardinality(ancestors) > 0;
 """)
             sys.stderr.write('added pid column to name table\n')
 
+        # convert legacy content_* columns in one server-side DO block
+        # rather than a client loop issuing DDL per table
+        del conn.notices[:]
         cur.execute("""
-SELECT table_name
-FROM information_schema.columns
-WHERE table_schema = 'hatrac' 
-  AND table_name = ANY (ARRAY['version', 'upload'])
-  AND column_name = 'content_type'
-EXCEPT
-SELECT table_name
-FROM information_schema.columns
-WHERE table_schema = 'hatrac' 
-  AND table_name = ANY (ARRAY['version', 'upload'])
-  AND column_name = 'metadata';
-""")
-        for tname in [ row[0] for row in cur ]:
-            sys.stderr.write('converting %s to have metadata column... ' % tname)
-            cur.execute("""
-ALTER TABLE hatrac.%(table)s ADD COLUMN metadata jsonb;
-UPDATE hatrac.%(table)s SET metadata = (
+DO $$
+DECLARE
+  t text;
+BEGIN
+  FOR t IN
+    SELECT table_name
+    FROM information_schema.columns
+    WHERE table_schema = 'hatrac'
+      AND table_name = ANY (ARRAY['version', 'upload'])
+      AND column_name = 'content_type'
+    EXCEPT
+    SELECT table_name
+    FROM information_schema.columns
+    WHERE table_schema = 'hatrac'
+      AND table_name = ANY (ARRAY['version', 'upload'])
+      AND column_name = 'metadata'
+  LOOP
+    EXECUTE format($f$
+ALTER TABLE hatrac.%1$I ADD COLUMN metadata jsonb;
+UPDATE hatrac.%1$I SET metadata = (
   CASE WHEN content_type IS NOT NULL THEN jsonb_build_object('content-type', content_type) ELSE '{}'::jsonb END
   || CASE WHEN content_md5 IS NOT NULL THEN jsonb_build_object('content-md5', content_md5) ELSE '{}'::jsonb END
 );
-ALTER TABLE hatrac.%(table)s DROP COLUMN content_type;
-ALTER TABLE hatrac.%(table)s DROP COLUMN content_md5;
-ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
-""" % dict(table=sql_identifier(tname))
-            )
-            sys.stderr.write('done.\n')
+ALTER TABLE hatrac.%1$I DROP COLUMN content_type;
+ALTER TABLE hatrac.%1$I DROP COLUMN content_md5;
+ALTER TABLE hatrac.%1$I ALTER COLUMN metadata SET NOT NULL;
+$f$, t);
+    RAISE NOTICE 'converted % to have metadata column', t;
+  END LOOP;
+END
+$$;
+""")
+        for notice in conn.notices:
+            sys.stderr.write(notice.replace('NOTICE:  ', '', 1))
         
     @db_wrap()
     def deploy_db(self, admin_roles, conn=None, cur=None):
@@ -955,45 +1316,59 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
         # prepare statements again since they would have failed prior to above deploy SQL steps...
         conn._prepare_hatrac_stmts()
 
-        rootns = HatracNamespace(self, **(self._name_lookup(conn, cur, '/')))
+        row = self._name_lookup(conn, cur, '/')
+        rootns = HatracNamespace(self, **row)
 
+        # append missing admin roles in one UPDATE rather than one per role
+        owner = list(row['owner'] or [])
         for role in admin_roles:
-            self._set_resource_acl_role(conn, cur, rootns, 'owner', role)
+            role = role['id'] if type(role) is dict else role
+            if role not in owner:
+                owner.append(role)
+        if len(owner) > len(row['owner'] or []):
+            self._set_resource_acl(conn, cur, rootns, 'owner', owner)
             
     @db_wrap()
     def create_name(self, name, is_object, make_parents, client_context, conn=None, cur=None):
         """Create, persist, and return a HatracNamespace or HatracObject instance.
 
         """
+        nameparts = [ n for n in name.split('/') if n ]
+        if make_parents:
+            # fetch every ancestor that might be needed in one round trip
+            names = [ "/" + "/".join(nameparts[0:i]) for i in range(len(nameparts), -1, -1) ]
+        else:
+            names = [ name, "/" + "/".join(nameparts[0:-1]) ]
+        rows = self._name_lookup_many(conn, cur, names)
+        return self._create_name_path(conn, cur, name, is_object, make_parents, client_context, rows)
+
+    def _create_name_path(self, conn, cur, name, is_object, make_parents, client_context, rows):
         nameparts = [ n for n in name.split('/') if n ]
         parname = "/" + "/".join(nameparts[0:-1])
         relname = nameparts[-1]
         if relname in [ '.', '..' ]:
             raise core.BadRequest('Illegal name "%s".' % relname)
 
-        try:
-            resource = HatracName.construct(self, **self._name_lookup(conn, cur, name, False))
+        row = rows.get(name)
+        if row is not None:
+            resource = HatracName.construct(self, **row)
             if resource.is_deleted:
                 raise core.Conflict('Name %s not available.' % resource)
             else:
                 raise core.Conflict('Name %s already in use.' % resource)
-        except core.NotFound as ev:
-            pass
 
-        try:
-            parent = HatracName.construct(self, **self._name_lookup(conn, cur, parname))
+        row = rows.get(parname)
+        if row is not None and not row['is_deleted']:
+            parent = HatracName.construct(self, **row)
             if parent.is_object():
                 raise core.Conflict('Parent %s is not a namespace.' % (self.prefix + parname))
-        except core.NotFound:
-            if make_parents:
-                parent = self.create_name(parname, False, True, client_context, conn=conn, cur=cur)
-            else:
-                raise
+        elif make_parents:
+            parent = self._create_name_path(conn, cur, parname, False, True, client_context, rows)
+        else:
+            raise core.NotFound('Resource %s not found.' % (self.prefix + parname))
 
         parent.enforce_acl(['owner', 'create', 'ancestor_owner', 'ancestor_create'], client_context)
-        resource = HatracName.construct(self, **self._create_name(conn, cur, name, parent.id, parent.ancestors + [parent.id], is_object))
-        self._set_resource_acl_role(conn, cur, resource, 'owner', client_context.client)
-        return resource
+        return HatracName.construct(self, **self._create_name(conn, cur, name, parent.id, parent.ancestors + [parent.id], is_object, client_context.client))
 
     @db_wrap(enforce_acl=(1, 2, ['owner', 'ancestor_owner']), transform=lambda thunk: thunk())
     def delete_name(self, resource, client_context, conn=None, cur=None):
@@ -1002,43 +1377,113 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
             raise core.Forbidden('Root service namespace %s cannot be deleted.' % resource)
 
         # test ACLs and map out recursive delete
-        deleted_uploads = []
-        deleted_versions = []
-        deleted_names = []
+        plan = dict(upload=[], version=[], name=[])
+        for row in self._delete_plan(conn, cur, resource):
+            plan[row['kind']].append(row)
 
-        for row in self._namespace_enumerate_uploads(conn, cur, resource):
-            deleted_uploads.append( web_storage(row) )
+        deleted_uploads = [ web_storage(row) for row in plan['upload'] ]
 
-        for row in self._namespace_enumerate_versions(conn, cur, resource):
-            obj = HatracObject(self, **row)
-            HatracObjectVersion(self, obj, **row).enforce_acl(['owner', 'subtree-owner', 'ancestor_owner'], client_context)
-            deleted_versions.append( web_storage(row) )
+        rows = plan['version']
+        self._enforce_columns_acl(
+            self._enumerate_columns(rows, ['name', 'version', 'owner', 'subtree-owner', 'ancestor_owner']),
+            lambda name, version: '%s%s:%s' % (self.prefix, name, version),
+            client_context
+        )
+        deleted_versions = [ web_storage(row) for row in rows ]
 
-        for row in self._namespace_enumerate_names(conn, cur, resource):
-            HatracName.construct(self, **row).enforce_acl(['owner', 'ancestor_owner'], client_context)
-            deleted_names.append( web_storage(row) )
+        rows = plan['name']
+        self._enforce_columns_acl(
+            self._enumerate_columns(rows, ['name', 'owner', 'ancestor_owner']),
+            lambda name: self.prefix + name,
+            client_context
+        )
+        deleted_names = [ web_storage(row) for row in rows ]
 
         # we only get here if no ACL raised an exception above
         deleted_names.append(resource)
 
-        for res in deleted_uploads:
-            self._delete_upload(conn, cur, res)
-        for res in deleted_versions:
-            self._delete_version(conn, cur, res)
-        for res in deleted_names:
-            self._delete_name(conn, cur, res)
+        self._delete_subtree(
+            conn, cur, resource,
+            [ res.id for res in deleted_uploads ],
+            [ res.id for res in deleted_versions ],
+            [ res.id for res in deleted_names ]
+        )
+
+        def storage_call(func, *args, **kwargs):
+            try:
+                func(*args, **kwargs)
+            except Exception as ev:
+                # DB deletion is already committed so this only leaves orphaned storage
+                hatrac_debug('ignoring storage cleanup error for %s: %s' % (args[0], ev))
+
+        def delete_versions(versions):
+            try:
+                failures = self.storage.delete_many(versions)
+            except Exception as ev:
+                failures = [ (name, version, ev) for name, version, aux in versions ]
+            for name, version, ev in failures:
+                hatrac_debug('ignoring storage cleanup error for %s:%s: %s' % (name, version, ev))
 
         def cleanup():
             # tell storage system to clean up after deletes were committed to DB
-            for res in deleted_uploads:
-                self.storage.cancel_upload(res.name, res.job)
-            for res in deleted_versions:
-                self.storage.delete(res.name, res.version, aux=res.aux)
+            versions = [ (res.name, res.version, res.aux) for res in deleted_versions ]
+            batch = self._storage_delete_batch
+            calls = [
+                (storage_call, self.storage.cancel_upload, res.name, res.job)
+                for res in deleted_uploads
+            ] + [
+                (delete_versions, versions[i:i+batch])
+                for i in range(0, len(versions), batch)
+            ]
+            if len(calls) > 1:
+                # each worker runs in its own copy of the request context so storage
+                # backends can still reach the flask app context and request trace
+                futures = [ self._storage_pool.submit(contextvars.copy_context().run, *call) for call in calls ]
+                for future in futures:
+                    future.result()
+            else:
+                # a single storage call is not worth the hand-off to the pool
+                for func, *args in calls:
+                    func(*args)
+            # namespaces go last and in order, since their content must be gone first
             for res in deleted_names:
-                self.storage.delete_namespace(res.name)
+                storage_call(self.storage.delete_namespace, res.name)
 
         return cleanup
 
+    @staticmethod
+    def _enumerate_columns(rows, names):
+        """Return a dict of per-column lists for the named columns of rows."""
+        return dict([
+            (name, [ row[name] for row in rows ])
+            for name in names
+        ])
+
+    @staticmethod
+    def _enforce_columns_acl(columns, describe, client_context=None):
+        """Enforce ACLs over bulk-enumerated rows without constructing resources.
+
+           columns: dict from _enumerate_columns() whose leading key
+             columns are passed to describe() and whose remaining ACL
+             columns are the accesses any of which grants permission
+           describe: function mapping key values to the resource string
+             used in the error message for a denied row
+
+        """
+        if client_context is None:
+            client_context = hatrac_ctx.webauthn2_context
+        core.set_acl_match_attributes(client_context)
+        attributes = client_context.acl_match_attributes
+        keys = [ c for c in columns if c in {'name', 'version'} ]
+        accesses = [ c for c in columns if c not in keys ]
+        for key, roles in zip(zip(*[ columns[c] for c in keys ]), zip(*[ columns[c] for c in accesses ])):
+            if any(acl and not attributes.isdisjoint(acl) for acl in roles):
+                continue
+            elif client_context.client is not None:
+                raise core.Forbidden('Access to %s forbidden.' % describe(*key))
+            else:
+                raise core.Unauthenticated('Authentication required for access to %s' % describe(*key))
+
     @db_wrap(enforce_acl=(1, 2, ['owner', 'ancestor_owner']), transform=lambda thunk: thunk())
     def delete_version(self, resource, client_context, conn=None, cur=None):
         """Delete an existing version."""
@@ -1051,19 +1496,24 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
 
            Newly created instance is marked 'deleted'.
         """
-        v = self._create_version(conn, cur, object, nbytes, metadata)
-        resource = HatracObjectVersion(self, object, **v)
-        self._set_resource_acl_role(conn, cur, resource, 'owner', client_context.client)
-        return resource
+        v = self._create_version(conn, cur, object, nbytes, metadata, client_context.client)
+        return HatracObjectVersion(self, object, **v)
 
     def create_version_from_file(self, object, input, client_context, nbytes, metadata={}):
         """Create, persist, and return HatracObjectVersion with given content.
 
+           The content is stored first so that the completed version
+           can be inserted and resolved in a single transaction.
         """
-        resource = self.create_version(object, client_context, nbytes, metadata)
+        object.enforce_acl(['owner', 'update', 'ancestor_owner', 'ancestor_update'], client_context)
         version = self.storage.create_from_file(object.name, input, nbytes, metadata)
-        self.pc.perform(lambda conn, cur: self._complete_version(conn, cur, resource, version))
-        return self.version_resolve(object, version)
+        return self._persist_version(object, version, client_context, nbytes, metadata)
+
+    # only inserts a new row, so snapshot isolation would add nothing
+    @db_wrap(isolation=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    def _persist_version(self, object, version, client_context, nbytes=None, metadata={}, conn=None, cur=None):
+        self._create_version(conn, cur, object, nbytes, metadata, client_context.client, version)
+        return self.version_resolve(object, version, conn=conn, cur=cur)
 
     @db_wrap()
     def version_aux_version_update(self, resource, version, client_context=None, conn=None, cur=None):
@@ -1079,22 +1529,30 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
 
     @db_wrap(enforce_acl=(1, 3, ['owner', 'update', 'ancestor_owner', 'ancestor_update']))
     def create_version_upload_job(self, object, chunksize, client_context, nbytes=None, metadata={}, conn=None, cur=None):
+        # reject layouts the storage would only refuse at finalize, after every chunk was sent
+        if nbytes is not None and nbytes > chunksize:
+            if chunksize < self.storage.min_chunksize:
+                raise core.BadRequest(
+                    'Upload chunk size %d is below the storage minimum of %d bytes.' % (chunksize, self.storage.min_chunksize)
+                )
+            if self.storage.max_chunks is not None and (nbytes + chunksize - 1) // chunksize > self.storage.max_chunks:
+                raise core.BadRequest(
+                    'Upload of %d bytes in %d byte chunks exceeds the storage limit of %d chunks.' % (nbytes, chunksize, self.storage.max_chunks)
+                )
         job = self.storage.create_upload(object.name, nbytes, metadata)
-        resource = HatracUpload(self, object, **self._create_upload(conn, cur, object, job, chunksize, nbytes, metadata))
-        self._set_resource_acl_role(conn, cur, resource, 'owner', client_context.client)
-        return resource
+        return HatracUpload(self, object, **self._create_upload(conn, cur, object, job, chunksize, nbytes, metadata, client_context.client))
 
     def upload_chunk_from_file(self, upload, position, input, client_context, nbytes, metadata={}):
         upload.enforce_acl(['owner'], client_context)
-        nchunks = upload.nbytes / upload.chunksize
-        remainder = upload.nbytes % upload.chunksize
+        nchunks, remainder = upload.nchunks, upload.remainder
         assert position >= 0
-        if position < (nchunks - 1) and nbytes != upload.chunksize:
-            raise core.Conflict('Uploaded chunk byte count %s does not match job chunk size %s.' % (nbytes, upload.chunksize))
-        if remainder and position == nchunks and nbytes != remainder:
-            raise core.Conflict('Uploaded chunk byte count %s does not match final chunk size %s.' % (nbytes, remainder))
         if position > nchunks or position == nchunks and remainder == 0:
             raise core.Conflict('Uploaded chunk number %s out of range.' % position)
+        # positions 0..nchunks-1 are full-size, so the last one must be checked too when remainder == 0
+        if position < nchunks and nbytes != upload.chunksize:
+            raise core.Conflict('Uploaded chunk byte count %s does not match job chunk size %s.' % (nbytes, upload.chunksize))
+        if position == nchunks and nbytes != remainder:
+            raise core.Conflict('Uploaded chunk byte count %s does not match final chunk size %s.' % (nbytes, remainder))
         aux = self.storage.upload_chunk_from_file(
             upload.object.name, 
             upload.job, 
@@ -1109,21 +1567,25 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
             self._track_chunk(conn, cur, upload, position, aux)
 
         if self.storage.track_chunks:
-            self.pc.perform(db_thunk)
+            # the upsert needs no snapshot, and READ COMMITTED lets racing re-uploads of a chunk both succeed
+            self.pc.perform(db_thunk, isolation=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
 
-    @db_wrap(enforce_acl=(1, 2, ['owner']))
+    @db_wrap(enforce_acl=(1, 2, ['owner']), isolation=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
     def upload_finalize(self, upload, client_context, conn=None, cur=None):
+        # claim the job before storage is touched, so a racing finalize fails
+        # fast and a racing cancel waits for this one to commit; the row lock
+        # does not block chunk uploads, and READ COMMITTED holds no snapshot
+        # across the storage finalize
+        self._upload_claim(conn, cur, upload)
         if self.storage.track_chunks:
             chunk_aux = list(self._chunk_list(conn, cur, upload))
         else:
             chunk_aux = None
         version_id = self.storage.finalize_upload(upload.name, upload.job, chunk_aux, metadata=upload.metadata)
-        version = HatracObjectVersion(self, upload.object, **self._create_version(conn, cur, upload.object, upload.nbytes, upload.metadata))
-        self._set_resource_acl_role(conn, cur, version, 'owner', client_context.client)
-        self._complete_version(conn, cur, version, version_id)
         self._delete_upload(conn, cur, upload)
-        version.version = version_id
-        return version
+        return HatracObjectVersion(self, upload.object, **self._create_version(
+            conn, cur, upload.object, upload.nbytes, upload.metadata, client_context.client, version_id
+        ))
 
     @db_wrap(enforce_acl=(1, 2, ['owner', 'ancestor_owner']), transform=lambda thunk: thunk())
     def upload_cancel(self, upload, client_context, conn=None, cur=None):
@@ -1135,10 +1597,12 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
         self._delete_upload(conn, cur, upload)
         return lambda : self.storage.cancel_upload(upload.name, upload.job)
 
-    # subtree-owner and subtree-read are from the parent object name record
-    @db_wrap(enforce_acl=(2, 4, ['owner', 'read', 'ancestor_owner', 'ancestor_read', 'subtree-owner', 'subtree-read']))
-    def get_version_content_range(self, object, objversion, get_slice, client_context, get_data=True, conn=None, cur=None):
+    def get_version_content_range(self, object, objversion, get_slice, client_context, get_data=True):
         """Return (nbytes, data_generator) pair for specific version."""
+        # objversion is already resolved and nothing below reads the DB,
+        # so no pooled connection or transaction is taken for HEAD or GET
+        # subtree-owner and subtree-read are from the parent object name record
+        objversion.enforce_acl(['owner', 'read', 'ancestor_owner', 'ancestor_read', 'subtree-owner', 'subtree-read'], client_context)
         if objversion.is_deleted:
             raise core.NotFound('Resource %s is not available.' % objversion)
         if get_data:
@@ -1158,7 +1622,7 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
         """Return (nbytes, data_generator) pair for specific version."""
         return self.get_version_content_range(object, objversion, None, client_context, get_data)
 
-    @db_wrap()
+    @db_wrap(readonly=True)
     def name_resolve(self, name, raise_notfound=True, conn=None, cur=None):
         """Return a HatracNamespace or HatracObject instance.
         """
@@ -1168,7 +1632,12 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
             if raise_notfound:
                 raise ev
 
-    @db_wrap()
+    @db_wrap(readonly=True)
+    def name_acls_lookup(self, resource, conn=None, cur=None):
+        """Return the ACL-enriched name row for a resource loaded without ACL columns."""
+        return self._name_lookup(conn, cur, resource.name, False)
+
+    @db_wrap(readonly=True)
     def version_resolve(self, object, version, raise_notfound=True, conn=None, cur=None):
         """Return a HatracObjectVersion instance corresponding to referenced version.
         """
@@ -1178,20 +1647,22 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
             **self._version_lookup(conn, cur, object, version, not raise_notfound)
         )
 
-    @db_wrap()
+    @db_wrap(readonly=True)
     def upload_resolve(self, object, job, raise_notfound=True, conn=None, cur=None):
         """Return a HatracUpload instance corresponding to referenced job.
         """
         return HatracUpload(self, object, **self._upload_lookup(conn, cur, object, job))
 
-    @db_wrap()
+    @db_wrap(readonly=True)
     def get_current_version(self, object, conn=None, cur=None):
         """Return a HatracObjectVersion instance corresponding to latest.
         """
         assert object.id is not None, object
-        results = self._version_list(conn, cur, object.id, limit=1)
-        if results:
-            return self.version_resolve(object, results[0]['version'], conn=conn, cur=cur)
+        # fetch the full row in the same probe rather than re-resolving by version string
+        cur.execute("EXECUTE hatrac_version_current(%s);", (object.id,))
+        row = cur.fetchone()
+        if row is not None:
+            return HatracObjectVersion(self, object, **self._version_row(conn, cur, object, row))
         else:
             raise core.Conflict('Object %s currently has no content.' % object)
 
@@ -1205,6 +1676,9 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
         
     @db_wrap(enforce_acl=(1, 4, ['owner', 'ancestor_owner']))
     def set_resource_acl_role(self, resource, access, role, client_context, conn=None, cur=None):
+        if access in resource._acl_names and role in resource.acl_sets[access]:
+            # already granted, so the UPDATE would be a no-op
+            return
         self._set_resource_acl_role(conn, cur, resource, access, role)
 
     @db_wrap(enforce_acl=(1, 4, ['owner', 'ancestor_owner']))
@@ -1221,23 +1695,53 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
     def clear_resource_acl(self, resource, access, client_context, conn=None, cur=None):
         self._set_resource_acl(conn, cur, resource, access, [])
 
-    @db_wrap()
+    @db_wrap(readonly=True)
     def object_enumerate_versions(self, object, conn=None, cur=None):
         """Return a list of versions
         """
+        columns = dict(name=object.name, pid=object.pid, ancestors=object.ancestors)
+        versions = []
+        for row in self._version_pages(conn, cur, object.id):
+            # rows are already fresh dicts, so add the name columns in place
+            row.update(columns)
+            versions.append(HatracObjectVersion(self, object, **row))
+        return versions
+
+    @db_wrap(readonly=True)
+    def object_enumerate_version_strings(self, object, conn=None, cur=None):
+        """Return a list of version URLs without constructing version resources."""
+        prefix = object.asurl() + ':'
         return [
-            HatracObjectVersion(self, HatracName.construct(self, subtype=1, **row), **row)
-            for row in self._version_list(conn, cur, object.id) 
+            prefix + urllib.parse.quote(row['version'], '')
+            for row in self._version_pages(conn, cur, object.id, decode_metadata=False)
         ]
 
-    @db_wrap()
-    def namespace_enumerate_names(self, resource, recursive=True, need_acls=True, conn=None, cur=None):
+    @db_wrap(readonly=True)
+    def namespace_enumerate_names(self, resource, recursive=True, with_acls=False, conn=None, cur=None):
+        """Return name resources under resource.
+
+           Names are identity-only unless with_acls is true.  Callers
+           that check ACLs on the results should ask for them here, in
+           one query, rather than have each name look them up later.
+        """
+        if not with_acls:
+            return HatracName.construct_rows(
+                self, self._namespace_stream_names(conn, resource, recursive, 'rows')
+            )
         return [
             HatracName.construct(self, **row)
-            for row in self._namespace_enumerate_names(conn, cur, resource, recursive, need_acls)
+            for row in self._namespace_enumerate_names(conn, cur, resource, recursive)
         ]
 
-    @db_wrap()
+    @db_wrap(readonly=True)
+    def namespace_enumerate_name_strings(self, resource, recursive=True, conn=None, cur=None):
+        """Return a list of name URLs without constructing name resources."""
+        return [
+            self.prefix + row[0]
+            for row in self._namespace_enumerate_name_strings(conn, cur, resource, recursive)
+        ]
+
+    @db_wrap(readonly=True)
     def namespace_enumerate_uploads(self, resource, recursive=True, conn=None, cur=None):
         return [
             HatracUpload(self, HatracName.construct(self, subtype=1, **row), **row)
@@ -1246,272 +1750,293 @@ ALTER TABLE hatrac.%(table)s ALTER COLUMN metadata SET NOT NULL;
 
     def _update_resource_metadata(self, conn, cur, resource, updates):
         resource.metadata.update(updates)
-        cur.execute("""
-UPDATE hatrac.%(table)s n
-SET metadata = %(metadata)s
-WHERE n.id = %(id)s ;
-""" % dict(
-    table=sql_identifier(resource._table_name),
-    id=sql_literal(resource.id),
-    metadata=sql_literal(resource.metadata.to_sql())
-)
-        )
+        self._write_resource_metadata(conn, cur, resource)
 
     def _pop_resource_metadata(self, conn, cur, resource, fieldname):
         resource.metadata.pop(fieldname)
-        cur.execute("""
-UPDATE hatrac.%(table)s n
-SET metadata = %(metadata)s
-WHERE n.id = %(id)s ;
-""" % dict(
-    table=sql_identifier(resource._table_name),
-    id=sql_literal(resource.id),
-    metadata=sql_literal(resource.metadata.to_sql())
-)
+        self._write_resource_metadata(conn, cur, resource)
+
+    def _write_resource_metadata(self, conn, cur, resource):
+        cur.execute(
+            "EXECUTE hatrac_metadata_set_%s (%%s, %%s);" % resource._table_name,
+            (resource.id, resource.metadata.to_sql())
         )
-        
+
     def _set_resource_acl_role(self, conn, cur, resource, access, role):
         if access not in resource._acl_names:
             raise core.BadRequest('Invalid ACL name %s for %s.' % (access, resource))
         role = role['id'] if type(role) is dict else role
-        # need to use raw SQL to compute modified array in database
-        cur.execute("""
-UPDATE hatrac.%(table)s n
-SET %(acl)s = array_append(coalesce(n.%(acl)s, ARRAY[]::text[]), %(role)s)
-WHERE n.id = %(id)s
-  AND NOT coalesce(ARRAY[%(role)s] && n.%(acl)s, False);
-""" % dict(
-    table=sql_identifier(resource._table_name),
-    acl=sql_identifier(access),
-    id=sql_literal(resource.id),
-    role=sql_literal(role)
-)
+        # compute modified array in database
+        cur.execute(
+            "EXECUTE hatrac_acl_add_%s (%%s, %%s, %%s);" % resource._table_name,
+            (resource.id, access, role)
         )
-        resource.acls[access].add(role)
+        resource._acl_replace(access, resource.acl_sets[access] | {role})
 
     def _drop_resource_acl_role(self, conn, cur, resource, access, role):
         if access not in resource._acl_names:
             raise core.BadRequest('Invalid ACL name %s for %s.' % (access, resource))
         role = role['id'] if type(role) is dict else role
-        # need to use raw SQL to compute modified array in database
-        cur.execute("""
-UPDATE hatrac.%(table)s n
-SET %(acl)s = array_remove(coalesce(n.%(acl)s, ARRAY[]::text[]), %(role)s)
-WHERE n.id = %(id)s
-  AND coalesce(ARRAY[%(role)s] && n.%(acl)s, False);
-""" % dict(
-    table=sql_identifier(resource._table_name),
-    acl=sql_identifier(access),
-    id=sql_literal(resource.id),
-    role=sql_literal(role)
-)
+        # compute modified array in database
+        cur.execute(
+            "EXECUTE hatrac_acl_drop_%s (%%s, %%s, %%s);" % resource._table_name,
+            (resource.id, access, role)
         )
-        resource.acls[access].add(role)
+        resource._acl_replace(access, resource.acl_sets[access] - {role})
 
     def _set_resource_acl(self, conn, cur, resource, access, acl):
         if access not in resource._acl_names:
             raise core.BadRequest('Invalid ACL name %s for %s.' % (access, resource))
-        cur.execute("""
-UPDATE hatrac.%(table)s r 
-SET %(acl)s = ARRAY[%(roles)s]::text[]
-WHERE r.id = %(id)s 
-""" % dict(
-    table=sql_identifier(resource._table_name),
-    id=sql_literal(resource.id),
-    acl=sql_identifier(access),
-    roles=','.join(map(sql_literal, acl))
-)
+        cur.execute(
+            "EXECUTE hatrac_acl_set_%s (%%s, %%s, %%s::text[]);" % resource._table_name,
+            (resource.id, access, list(acl))
         )
-        resource.acls[access] = ACL(acl)
+        resource._acl_replace(access, acl)
 
-    def _create_name(self, conn, cur, name, pid, ancestors, is_object=False):
-        cur.execute("""
-INSERT INTO hatrac.name
-(name, pid, ancestors, subtype, is_deleted)
-VALUES (%(name)s, %(pid)s, ARRAY[%(ancestors)s]::int8[], %(isobject)s, False)
-RETURNING *
-""" % dict(
-    name=sql_literal(name),
-    pid=sql_literal(pid),
-    ancestors=','.join([ sql_literal(a) for a in ancestors ]),
-    isobject=is_object and 1 or 0
-)
-        )
-        return list(cur)[0]
+    def _owner_acl(self, owner):
+        # initial owner ACL is written by the INSERT rather than a follow-up UPDATE
+        return [ owner['id'] if type(owner) is dict else owner ]
 
-    def _create_version(self, conn, cur, object, nbytes=None, metadata={}):
-        cur.execute("""
-INSERT INTO hatrac.version
-(nameid, nbytes, metadata, is_deleted)
-VALUES (%(nameid)s, %(nbytes)s, %(metadata)s, True)
-RETURNING *, %(name)s AS "name", %(pid)s AS pid, ARRAY[%(ancestors)s]::int8[] AS "ancestors"
-""" % dict(
-    name=sql_literal(object.name),
-    nameid=sql_literal(object.id),
-    pid=sql_literal(object.pid),
-    ancestors=','.join([sql_literal(a) for a in object.ancestors]),
-    nbytes=nbytes is not None and sql_literal(int(nbytes)) or 'NULL::int8',
-    metadata=sql_literal(metadata.to_sql())
-)
+    def _create_name(self, conn, cur, name, pid, ancestors, is_object=False, owner=None):
+        cur.execute(
+            "EXECUTE hatrac_create_name(%s, %s, %s, %s, %s);",
+            (name, pid, list(ancestors), is_object and 1 or 0, self._owner_acl(owner))
+        )
+        return cur.fetchone()
+
+    def _create_version(self, conn, cur, object, nbytes=None, metadata={}, owner=None, version=None):
+        # without a storage version, the new row stays invisible until _complete_version
+        cur.execute(
+            "EXECUTE hatrac_create_version(%s, %s, %s, %s, %s, %s);",
+            (
+                object.id,
+                version,
+                int(nbytes) if nbytes is not None else None,
+                metadata.to_sql(),
+                version is None,
+                self._owner_acl(owner)
+            )
         )
-        return list(cur)[0]
+        # the caller already holds the object's name columns
+        return dict(cur.fetchone(), name=object.name, pid=object.pid, ancestors=object.ancestors)
 
-    def _create_upload(self, conn, cur, object, job, chunksize, nbytes, metadata):
-        cur.execute("""
-INSERT INTO hatrac.upload 
-(nameid, job, nbytes, chunksize, metadata)
-VALUES (%(nameid)s, %(job)s, %(nbytes)s, %(chunksize)s, %(metadata)s)
-RETURNING *, %(name)s AS "name", %(pid)s AS pid, ARRAY[%(ancestors)s]::int8[] AS "ancestors"
-""" % dict(
-    name=sql_literal(object.name),
-    ancestors=','.join([sql_literal(a) for a in object.ancestors]),
-    nameid=sql_literal(object.id),
-    pid=sql_literal(object.pid),
-    job=sql_literal(job),
-    nbytes=sql_literal(int(nbytes)),
-    chunksize=sql_literal(int(chunksize)),
-    metadata=sql_literal(metadata.to_sql())
-)
+    def _create_upload(self, conn, cur, object, job, chunksize, nbytes, metadata, owner=None):
+        cur.execute(
+            "EXECUTE hatrac_create_upload(%s, %s, %s, %s, %s, %s);",
+            (object.id, job, int(nbytes), int(chunksize), metadata.to_sql(), self._owner_acl(owner))
         )
-        return list(cur)[0]
+        return dict(cur.fetchone(), name=object.name, pid=object.pid, ancestors=object.ancestors)
 
     def _track_chunk(self, conn, cur, upload, position, aux):
-        sql_fields = dict(
-            uploadid=sql_literal(upload.id),
-            position=sql_literal(int(position)),
-            aux=sql_literal(json.dumps(aux, ensure_ascii=False))
+        # a re-uploaded chunk replaces the earlier aux in the same statement
+        cur.execute(
+            "EXECUTE hatrac_track_chunk(%s, %s, %s);",
+            (upload.id, int(position), json.dumps(aux, ensure_ascii=False))
         )
-        
-        try:
-            result = self._chunk_lookup(conn, cur, upload, position)
-            cur.execute("""
-UPDATE hatrac.chunk
-SET aux = %(aux)s
-WHERE uploadid = %(uploadid)s AND position = %(position)s
-""" % sql_fields
-            )
-            
-        except core.NotFound:
-            cur.execute("""
-INSERT INTO hatrac.chunk
-(uploadid, position, aux)
-VALUES (%(uploadid)s, %(position)s, %(aux)s)
-""" % sql_fields
-            )
 
     def _complete_version(self, conn, cur, resource, version, is_deleted=False):
-        cur.execute("EXECUTE hatrac_complete_version(%s, %s, %s);" % (
-            sql_literal(resource.id),
-            sql_literal(version),
-            sql_literal(is_deleted)
-        ))
+        cur.execute("EXECUTE hatrac_complete_version(%s, %s, %s);", (resource.id, version, is_deleted))
 
     def _delete_name(self, conn, cur, resource):
-        cur.execute("EXECUTE hatrac_delete_name(%s);" % sql_literal(resource.id))
+        cur.execute("EXECUTE hatrac_delete_name(%s);", (resource.id,))
+        if cur.fetchone() is None:
+            # deleted by a concurrent request since it was resolved
+            raise core.NotFound('Resource %s not found.' % resource)
 
     def _delete_version(self, conn, cur, resource):
-        cur.execute("EXECUTE hatrac_delete_version(%s);" % sql_literal(resource.id))
+        cur.execute("EXECUTE hatrac_delete_version(%s);", (resource.id,))
+        if cur.fetchone() is None:
+            raise core.NotFound('Resource %s not available.' % resource)
+
+    def _upload_claim(self, conn, cur, upload):
+        cur.execute("EXECUTE hatrac_upload_claim(%s);", (upload.id,))
+        if cur.fetchone() is not None:
+            return
+        cur.execute("EXECUTE hatrac_upload_exists(%s);", (upload.id,))
+        if cur.fetchone() is None:
+            raise core.NotFound('Resource %s not found.' % upload)
+        raise core.Conflict('Upload %s is already being finalized or cancelled.' % upload)
 
     def _delete_upload(self, conn, cur, resource):
         cur.execute("""
 EXECUTE hatrac_delete_chunks(%(id)s);
 EXECUTE hatrac_delete_upload(%(id)s);
-""" % dict(id=sql_literal(resource.id))
+""", dict(id=resource.id)
         )
+        if cur.fetchone() is None:
+            # finalized or cancelled by a concurrent request since it was resolved
+            raise core.NotFound('Resource %s not found.' % resource)
+
+    def _delete_subtree(self, conn, cur, resource, upload_ids, version_ids, name_ids):
+        # one round trip for the whole recursive delete; empty arrays match nothing
+        # and the names update runs last so its RETURNING rows are the result
+        cur.execute("""
+EXECUTE hatrac_delete_uploads_chunks(%(uploads)s::int8[]);
+EXECUTE hatrac_delete_uploads(%(uploads)s::int8[]);
+EXECUTE hatrac_delete_versions(%(versions)s::int8[]);
+EXECUTE hatrac_delete_names(%(names)s::int8[]);
+""", dict(uploads=upload_ids, versions=version_ids, names=name_ids)
+        )
+        if resource.id not in set([ row[0] for row in cur ]):
+            # deleted by a concurrent request since it was resolved
+            raise core.NotFound('Resource %s not found.' % resource)
 
     def _name_lookup(self, conn, cur, name, check_deleted=True):
-        cur.execute("EXECUTE hatrac_name_lookup(%s, %s);" % (
-            sql_literal(name),
-            sql_literal(check_deleted)
-        ))
-        for row in list(cur):
+        cur.execute("EXECUTE hatrac_name_lookup(%s, %s);", (name, check_deleted))
+        row = cur.fetchone()
+        if row is not None:
             return row
         raise core.NotFound('Resource %s not found.' % (self.prefix + name))
         
+    def _name_lookup_many(self, conn, cur, names):
+        """Return a dict mapping each existing name in names to its row, deleted or not."""
+        cur.execute("EXECUTE hatrac_name_lookup_many(%s);", (list(names),))
+        return { row['name']: row for row in cur }
+
+    def _acl_ensure(self, conn, cur, resource):
+        """Load ACLs deferred by identity-only name enumeration using the caller's transaction."""
+        if isinstance(resource, HatracName) and resource._table_name == 'name' and resource._acl_sets is None:
+            resource._acl_load(**self._name_lookup(conn, cur, resource.name, False))
+
+    def _object_name_columns(self, conn, cur, object, acl_names):
+        """Return name row columns for versions or uploads from an already resolved object.
+
+           This replaces joining hatrac.name and recomputing ancestor
+           ACLs in every version or upload lookup.
+        """
+        self._acl_ensure(conn, cur, object)
+        columns = dict(name=object.name, pid=object.pid, ancestors=object.ancestors)
+        for an in acl_names:
+            columns[an] = list(object.acl_sets[an])
+        return columns
+
     def _version_lookup(self, conn, cur, object, version, allow_deleted=True):
-        cur.execute("EXECUTE hatrac_version_lookup(%s, %s);" % (
-            sql_literal(int(object.id)),
-            sql_literal(version)
-        ))
-        for row in list(cur):
+        cur.execute("EXECUTE hatrac_version_lookup(%s, %s);", (object.id, version))
+        row = cur.fetchone()
+        if row is not None:
             if row['is_deleted'] and not allow_deleted:
                 raise core.NotFound("Resource %s:%s not available." % (object, version))
             else:
-                row['metadata'] = Metadata.from_sql(row['metadata'])
-                return row
+                return self._version_row(conn, cur, object, row)
         raise core.NotFound("Resource %s:%s not found." % (object, version))
 
-    def _upload_lookup(self, conn, cur, object, job):
-        cur.execute("EXECUTE hatrac_upload_lookup(%s, %s);" % (
-            sql_literal(int(object.id)),
-            sql_literal(job)
+    def _version_row(self, conn, cur, object, row):
+        row = dict(row)
+        row['metadata'] = Metadata.from_sql(row['metadata'])
+        row.update(self._object_name_columns(
+            conn, cur, object,
+            ['subtree-owner', 'subtree-read', 'ancestor_owner', 'ancestor_read']
         ))
-        for row in list(cur):
+        return row
+
+    def _upload_lookup(self, conn, cur, object, job):
+        cur.execute("EXECUTE hatrac_upload_lookup(%s, %s);", (object.id, job))
+        row = cur.fetchone()
+        if row is not None:
+            row = dict(row)
             row['metadata'] = Metadata.from_sql(row['metadata'])
+            row.update(self._object_name_columns(conn, cur, object, ['ancestor_owner']))
             return row
         raise core.NotFound("Resource %s;upload/%s not found." % (object, job))
         
-    def _chunk_lookup(self, conn, cur, upload, position):
-        result = self._chunk_list(conn, cur, upload, position)
-        if not result:
-            raise core.NotFound("Resource %s/%s not found." % (upload, position))
-        return result[0]
-        
-    def _version_list(self, conn, cur, nameid, limit=None):
-        # TODO: add range keying for scrolling enumeration?
-        cur.execute("EXECUTE hatrac_version_list(%d, %s);" % (
-            nameid,
-            ("%d" % limit) if limit is not None else 'NULL'
-        ))
-        def helper(row):
-            row['metadata'] = Metadata.from_sql(row['metadata'])
-            return row
-        return [ helper(row) for row in cur ]
+    def _version_list(self, conn, cur, nameid, limit=None, after_id=None, decode_metadata=True):
+        """Return up to limit live versions, newest first, with id below after_id if given."""
+        if after_id is None:
+            cur.execute("EXECUTE hatrac_version_list_first(%s, %s);", (nameid, limit))
+        else:
+            cur.execute("EXECUTE hatrac_version_list_after(%s, %s, %s);", (nameid, limit, after_id))
+        if not decode_metadata:
+            return list(cur)
+        return [ dict(row, metadata=Metadata.from_sql(row['metadata'])) for row in cur ]
+
+    def _version_pages(self, conn, cur, nameid, page_size=1000, decode_metadata=True):
+        """Generate live versions, newest first, fetching page_size rows per query."""
+        after_id = None
+        while True:
+            rows = self._version_list(conn, cur, nameid, page_size, after_id, decode_metadata)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            after_id = rows[-1]['id']
         
     def _chunk_list(self, conn, cur, upload, position=None):
-        cur.execute("EXECUTE hatrac_chunk_list(%s, %s);" % (
-            sql_literal(int(upload.id)),
-            sql_literal(int(position)) if position is not None else 'NULL'
-        ))
+        # separate statements keep a plain index condition on UNIQUE (uploadid, position)
+        # in the generic plan, which an optional ($2 IS NULL OR ...) predicate defeats
+        if position is None:
+            cur.execute("EXECUTE hatrac_chunk_list(%s);", (upload.id,))
+        else:
+            cur.execute("EXECUTE hatrac_chunk_get(%s, %s);", (upload.id, position))
         result = list(cur)
         if not result:
             raise core.NotFound("Chunk data %s/%s not found." % (upload, position))
         return result
 
-    def _namespace_enumerate_versions(self, conn, cur, resource):
-        # return every version under /name... or /name/
-        if resource.is_object():
-            cur.execute("EXECUTE hatrac_object_enumerate_versions(%s);" % sql_literal(int(resource.id)))
+    def _delete_plan(self, conn, cur, resource):
+        # return every upload, version, and name under resource in one round trip,
+        # with just the columns delete_name needs for owner checks and storage cleanup
+        cur.execute("EXECUTE hatrac_delete_plan(%s);", (resource.id,))
+        return list(cur)
+
+    def _namespace_stream_names(self, conn, resource, recursive, columns):
+        """Return a _stream_query generator of live name tuples under resource.
+
+           Tuples follow _namespace_names_columns[columns], sparing
+           the per-row DictRow work.
+        """
+        if not recursive:
+            scope = 'children'
+        elif resource.pid is None:
+            # every name except the root itself descends from the root, so skip the array test
+            scope = 'root'
         else:
-            cur.execute("EXECUTE hatrac_namepattern_enumerate_versions(%s);" % sql_literal(sql_literal("^" + regexp_escape(resource.name) + '/')))
-        def helper(row):
-            row['metadata'] = Metadata.from_sql(row['metadata'])
-            return row
-        return [ helper(row) for row in cur ]
+            scope = 'subtree'
+        return self._stream_query(
+            conn, 'hatrac_namespace_names', _namespace_names_sql[(columns, scope)], dict(id=resource.id),
+            psycopg2.extensions.cursor
+        )
 
-    def _namespace_enumerate_names(self, conn, cur, resource, recursive=True, need_acls=True):
-        cur.execute("EXECUTE hatrac_namespace_%s_%sacl (%s);" % (
-            'subtree' if recursive else 'children',
-            '' if need_acls else 'no',
-            sql_literal(int(resource.id))
-        ))
+    def _stream_query(self, conn, cursor_name, sql, params, cursor_factory=DictCursor):
+        """Generate result rows of sql through a server-side cursor.
+
+           Rows are fetched in windows of _stream_itersize so neither
+           libpq nor psycopg2 buffers the whole result at once.  The
+           generator must be consumed inside the enclosing transaction.
+        """
+        cur = conn.cursor(name=cursor_name, cursor_factory=cursor_factory)
+        cur.itersize = self._stream_itersize
+        try:
+            cur.execute(sql, params)
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+    def _namespace_enumerate_names(self, conn, cur, resource, recursive=True):
+        cur.execute(
+            "EXECUTE hatrac_namespace_subtree_acl (%s);" if recursive else "EXECUTE hatrac_namespace_children_acl (%s);",
+            (resource.id,)
+        )
         return list(cur)
     
+    def _namespace_enumerate_name_strings(self, conn, cur, resource, recursive=True):
+        return self._namespace_stream_names(conn, resource, recursive, 'names')
+
     def _namespace_enumerate_uploads(self, conn, cur, resource, recursive=True):
-        # return every upload under /name... or /name/
-        cur.execute("EXECUTE hatrac_%s_uploads (%s);" % (
-            'object' if resource.is_object() else 'namespace',
-            sql_literal(int(resource.id))
-        ))
-        return list(cur)
+        # generate every upload under /name... or /name/
+        return self._stream_query(
+            conn, 'hatrac_namespace_uploads',
+            _namespace_uploads_sql['object' if resource.is_object() else 'namespace'],
+            dict(id=resource.id)
+        )
 
     def _hatrac_version_aux_url_update(self, conn, cur, resource, url_prefix):
-        cur.execute("EXECUTE hatrac_version_aux_url_update(%s, %s);" %
-                    (sql_literal(resource.id), sql_literal(url_prefix + resource.asurl())))
+        cur.execute("EXECUTE hatrac_version_aux_url_update(%s, %s);",
+                    (resource.id, url_prefix + resource.asurl()))
 
     def _hatrac_version_aux_url_delete(self, conn, cur, resource):
-        cur.execute("EXECUTE hatrac_version_aux_url_delete(%s);" % (sql_literal(resource.id)))
+        cur.execute("EXECUTE hatrac_version_aux_url_delete(%s);", (resource.id,))
 
     def _hatrac_version_aux_version_update(self, conn, cur, resource, version):
-        cur.execute("EXECUTE hatrac_version_aux_version_update(%s, %s);" %
-                    (sql_literal(resource.id), sql_literal(version)))
+        cur.execute("EXECUTE hatrac_version_aux_version_update(%s, %s);",
+                    (resource.id, version))
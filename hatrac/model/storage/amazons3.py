@@ -10,16 +10,19 @@ object-version lifecycle and authorization is handled by the caller.
 
 """
 import base64
-import binascii
+import functools
+import io
 import boto3
+import botocore.config
 import sys
 import os
-from collections import namedtuple
-from io import BufferedRandom, BytesIO
+import itertools
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 import urllib.parse
 from botocore.exceptions import ClientError
-from flask import g as hatrac_ctx
-from ...core import hatrac_debug, coalesce, max_request_payload_size_default
+from flask import g as hatrac_ctx, has_app_context
+from ...core import hatrac_debug, coalesce
 from ...core import NotFound, BadRequest, Conflict, Redirect, ObjectVersionMissing
 from .filesystem import make_random_version
 
@@ -33,6 +36,7 @@ def s3_bucket_wrap():
     """
 
     def decorator(orig_method):
+        @functools.wraps(orig_method)
         def wrapper(*args, **kwargs):
             self = args[0]
             try:
@@ -43,7 +47,8 @@ def s3_bucket_wrap():
                 return orig_method(*args, **kwargs1)
                 # TODO: catch and map S3 exceptions into hatrac.core.* exceptions?
             except ClientError as s3_error:
-                if "hatrac_request_trace" in hatrac_ctx:
+                # storage cleanup may also run on worker threads with no app context
+                if has_app_context() and "hatrac_request_trace" in hatrac_ctx:
                     hatrac_ctx.hatrac_request_trace("S3 client error: %s" % s3_error)
                 raise BadRequest(s3_error)
             except Exception:
@@ -54,15 +59,6 @@ def s3_bucket_wrap():
     return decorator
 
 
-def rewrite_path(path):
-    """Rewrite a path into a canonical form /path/. """
-    path = path.strip('/')
-    if path:
-        return '/%s/' % (path,)
-    else:
-        return '/'
-
-
 def explode_path(p):
     """Return list of path elements with empty list for root path"""
     p = p.strip('/')
@@ -77,14 +73,51 @@ def dict_get_first(d, *keys, default=None):
     return default
 
 
-def hatrac_dirname(name):
-    """Similar to os.path.dirname
+class BufferReader (io.RawIOBase):
+    """Seekable read-only file over a bytes-like buffer.
 
-    Always uses '/' separator regardless of platform.
-    Always returns leading and trailing '/'.
+    Unlike BytesIO(bytearray), this does not copy the buffer.
     """
-    path = '/'.join(name.strip('/').split('/')[0:-1])
-    return rewrite_path(path)
+
+    def __init__(self, buf):
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = bytes(self._view[self._pos:end])
+        self._pos = max(end, self._pos)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[0:len(data)] = data
+        return len(data)
+
+    def getbuffer(self):
+        """Return a new view of the whole buffer, as BytesIO.getbuffer() does."""
+        return memoryview(self._view)
+
+    def close(self):
+        self._view.release()
+        io.RawIOBase.close(self)
 
 
 class BucketTree (object):
@@ -133,7 +166,15 @@ class BucketConfigMapper (object):
 
     def get_bucket_config(self, hatrac_object_name):
         """Return bucket_config appropriate for given hatrac_object_name."""
-        object_path = explode_path(hatrac_dirname(hatrac_object_name))
+        # every object in a namespace maps to the same bucket, so memoize by parent path
+        bucket_config = self._parent_bucket_config(hatrac_object_name.rstrip('/').rpartition('/')[0])
+        if bucket_config is None:
+            raise ValueError('Invalid bucket mapping, bucket indeterminate for object: %r' % (hatrac_object_name))
+        return bucket_config
+
+    @functools.lru_cache(maxsize=4096)
+    def _parent_bucket_config(self, parent_path):
+        object_path = explode_path(parent_path)
         # find most specific tree node matching object path
         subtree = self.bucket_tree
         last_with_bucket = subtree
@@ -143,8 +184,6 @@ class BucketConfigMapper (object):
             subtree = subtree.children[prefix]
             if subtree.bucket_config is not None:
                 last_with_bucket = subtree
-        if last_with_bucket.bucket_config is None:
-            raise ValueError('Invalid bucket mapping, bucket indeterminate for object: %r' % (hatrac_object_name))
         return last_with_bucket.bucket_config
 
 
@@ -190,6 +229,16 @@ class BucketConfig (object):
         if not isinstance(self.presigned_url_threshold, int) \
            or self.presigned_url_threshold <= 0:
             self.presigned_url_threshold = None
+        self.multipart_threshold = bucket_config.get("multipart_threshold")
+        if not isinstance(self.multipart_threshold, int) \
+           or self.multipart_threshold <= 0:
+            self.multipart_threshold = None
+        self.parallel_read_threshold = bucket_config.get("parallel_read_threshold")
+        if not isinstance(self.parallel_read_threshold, int) \
+           or self.parallel_read_threshold <= 0:
+            self.parallel_read_threshold = None
+        # S3 rejects parts other than the last one below 5 MiB
+        self.multipart_chunksize = max(bucket_config.get("multipart_chunksize", 16 * 1024 ** 2), 5 * 1024 ** 2)
         # setup boto s3 client for this bucket
         # memoization to original config seems unnecessary but retain for now?
         self.client = bucket_config.get("s3_boto_client")
@@ -200,7 +249,12 @@ class BucketConfig (object):
                 session = boto3.session.Session(**session_config)
             if session is None:
                 session = boto3.session.Session()
-            client_config = bucket_config.get("client_config", dict())
+            client_config = dict(bucket_config.get("client_config", dict()))
+            # one client serves every request thread, so size its connection pool
+            # beyond the botocore default of 10 to keep sockets alive under load
+            botocore_config = dict(max_pool_connections=bucket_config.get("max_pool_connections", 50))
+            botocore_config.update(client_config.get("config", dict()))
+            client_config["config"] = botocore.config.Config(**botocore_config)
             self.client = session.client("s3", **client_config)
             bucket_config["s3_boto_client"] = self.client
 
@@ -210,6 +264,18 @@ class BucketConfig (object):
                 return True
         return False
 
+    def over_parallel_read_threshold(self, nbytes):
+        if self.parallel_read_threshold is not None:
+            if nbytes > self.parallel_read_threshold:
+                return True
+        return False
+
+    def over_multipart_threshold(self, nbytes):
+        if self.multipart_threshold is not None and nbytes is not None:
+            if nbytes > self.multipart_threshold:
+                return True
+        return False
+
     def object_key(self, hatrac_object_name, hatrac_object_version=None):
         key = (self.s3_method.s3_name_template % dict(
             bucket_prefix=self.bucket_prefix,
@@ -293,8 +359,18 @@ class HatracStorage:
     """
     track_chunks = True
 
+    # S3 multipart limits: every part but the last must reach 5 MiB, and at most 10000 parts
+    min_chunksize = 5 * 1024 ** 2
+    max_chunks = 10000
+
     _bufsize = 1024 ** 2 * 10
 
+    # ranged parts kept in flight per parallel whole-object read
+    _read_ahead = 4
+
+    # DeleteObjects accepts at most 1000 keys per request
+    _delete_batch = 1000
+
     def __init__(self, config):
         """Represents a Hatrac storage interface backed by S3 bucket(s).
 
@@ -310,56 +386,153 @@ class HatracStorage:
             self.s3_default_session,
             legacy_mode=legacy_mode,
         )
+        # shared by all requests to transfer the parts of large objects concurrently
+        self.transfer_workers = self.s3_config.get('max_concurrency', 10)
+        self.transfer_pool = ThreadPoolExecutor(max_workers=self.transfer_workers)
 
     @s3_bucket_wrap()
     def create_from_file(self, name, input, nbytes, metadata={}, bucket_config=None):
         """Create an entire file-version object from input content, returning version ID."""
         def sendfunc(inp, content_length, md5, content_type, content_disposition=None):
             version = bucket_config.preflight_hatrac_version()
-            response = bucket_config.client.put_object(**bucket_config.boto_kwargs(
-                Key=bucket_config.object_key(name, version),
-                Body=inp,
-                ContentType=content_type,
-                ContentLength=content_length,
-                ContentDisposition=content_disposition,
-                ContentMD5=md5[1].decode() if md5 else None
-            ))
+            if md5 is None and bucket_config.over_multipart_threshold(content_length):
+                # without a client MD5 for S3 to verify, large bodies can go as parallel parts
+                response = self._put_multipart(
+                    bucket_config, bucket_config.object_key(name, version),
+                    inp, content_length, content_type, content_disposition
+                )
+            else:
+                response = bucket_config.client.put_object(**bucket_config.boto_kwargs(
+                    Key=bucket_config.object_key(name, version),
+                    Body=inp,
+                    ContentType=content_type,
+                    ContentLength=content_length,
+                    ContentDisposition=content_disposition,
+                    ContentMD5=md5
+                ))
             return bucket_config.postflight_hatrac_version(version, response)
 
         return self._send_content_from_stream(input, nbytes, metadata, sendfunc)
 
-    def _send_content_from_stream(self, input, nbytes, metadata, sendfunc, chunksize=None):
+    def _put_multipart(self, bucket_config, key, inp, nbytes, content_type, content_disposition=None):
+        """Send buffered object content as a multipart upload, returning the completion response.
+
+           Parts of multipart_chunksize bytes are sent through
+           transfer_pool as views of the buffer behind inp, with at most
+           transfer_workers parts in flight.
+        """
+        response = bucket_config.client.create_multipart_upload(**bucket_config.boto_kwargs(
+            Key=key,
+            ContentType=content_type,
+            ContentDisposition=content_disposition,
+        ))
+        upload = response['UploadId']
+
+        view = inp.getbuffer()
+
+        def send_part(position, start, stop):
+            # sliced here so no view outlives a part that is cancelled before it runs
+            with view[start:stop] as part, BufferReader(part) as body:
+                response = bucket_config.client.upload_part(**bucket_config.boto_kwargs(
+                    Key=key,
+                    UploadId=upload,
+                    PartNumber=position + 1,
+                    Body=body,
+                    ContentLength=stop - start,
+                ))
+            return {'PartNumber': position + 1, 'ETag': response['ETag']}
+
+        partsize = bucket_config.multipart_chunksize
+        ranges = (
+            (position, start, min(start + partsize, len(view)))
+            for position, start in enumerate(range(0, len(view), partsize))
+        )
+        pending = deque()
+        try:
+            pending.extend([
+                self.transfer_pool.submit(send_part, *part)
+                for part in itertools.islice(ranges, self.transfer_workers)
+            ])
+            parts = []
+            while pending:
+                parts.append(pending.popleft().result())
+                part = next(ranges, None)
+                if part is not None:
+                    pending.append(self.transfer_pool.submit(send_part, *part))
+            return bucket_config.client.complete_multipart_upload(**bucket_config.boto_kwargs(
+                Key=key,
+                UploadId=upload,
+                MultipartUpload={'Parts': parts},
+            ))
+        except Exception:
+            for future in pending:
+                future.cancel()
+            # parts still in flight would survive an abort issued before they finish
+            wait(pending)
+            try:
+                bucket_config.client.abort_multipart_upload(**bucket_config.boto_kwargs(
+                    Key=key,
+                    UploadId=upload,
+                ))
+            except Exception as ev:
+                hatrac_debug('ignoring multipart abort error for %s: %s' % (key, ev))
+            raise
+        finally:
+            view.release()
+
+    def _send_content_from_stream(self, input, nbytes, metadata, sendfunc):
         """Common file-sending logic to talk to S3."""
         content_type = metadata.get('content-type', 'application/octet-stream')
         content_disposition = metadata.get('content-disposition')
+        # the digest was length-checked when decoded from HTTP, so only the
+        # base64 form S3 wants for Content-MD5 is produced here
         md5 = None
         if 'content-md5' in metadata:
-            content_md5 = metadata['content-md5']
-            md5 = (binascii.hexlify(content_md5), base64.b64encode(content_md5))
+            md5 = base64.b64encode(metadata['content-md5']).decode()
+
+        # boto3 needs a seekable body to sign and retry the request, so the
+        # payload is still held in memory, but as the received buffers
+        # joined once rather than copied through a pre-sized write buffer
+        if nbytes is not None and hasattr(input, 'readinto'):
+            # with a known size, read straight into one buffer that BufferReader
+            # wraps in place; the sender still copies it out block by block as it reads
+            data = bytearray(nbytes)
+            with memoryview(data) as view:
+                rbytes = 0
+                while rbytes < nbytes:
+                    blen = input.readinto(view[rbytes:rbytes + self._bufsize])
+                    if not blen:
+                        raise IOError('received %d of %d expected bytes' % (rbytes, nbytes))
+                    rbytes += blen
+            rbuf = BufferReader(data)
+            del data
+            try:
+                return sendfunc(rbuf, nbytes, md5, content_type=content_type, content_disposition=content_disposition)
+            finally:
+                rbuf.close()
 
         rbytes = 0
-        rbuf = BufferedRandom(
-            BytesIO(), chunksize or self.config.get("max_request_payload_size", max_request_payload_size_default))
+        bufs = []
+        while True:
+            if nbytes is not None:
+                buf = input.read(min(self._bufsize, nbytes - rbytes))
+            else:
+                buf = input.read(self._bufsize)
+
+            blen = len(buf)
+            if blen == 0:
+                if nbytes is not None and rbytes < nbytes:
+                    raise IOError('received %d of %d expected bytes' % (rbytes, nbytes))
+                break
+            rbytes += blen
+            bufs.append(buf)
+
+        rbuf = BufferReader(bufs[0] if len(bufs) == 1 else b''.join(bufs))
+        del bufs
         try:
-            while True:
-                if nbytes is not None:
-                    buf = input.read(min(self._bufsize, nbytes - rbytes))
-                else:
-                    buf = input.read(self._bufsize)
-
-                blen = len(buf)
-                rbytes += blen
-                rbuf.write(buf)
-
-                if blen == 0:
-                    if nbytes is not None and rbytes < nbytes:
-                        raise IOError('received %d of %d expected bytes' % (rbytes, nbytes))
-                    break
-            rbuf.seek(0)
             return sendfunc(rbuf, nbytes, md5, content_type=content_type, content_disposition=content_disposition)
         finally:
-            if rbuf:
-                rbuf.close()
+            rbuf.close()
 
     def get_content(self, name, version, metadata={}, aux={}):
         return self.get_content_range(name, version, metadata, None, aux=aux, version_nbytes=None)
@@ -419,6 +592,12 @@ class HatracStorage:
 
         length = limit - pos
 
+        parallel = get_slice is None and bucket_config.over_parallel_read_threshold(nbytes)
+        if parallel:
+            # fetch the first part here so a missing version still raises before the response starts
+            partsize = bucket_config.multipart_chunksize
+            content_range = 'bytes=0-%d' % (min(partsize, nbytes) - 1)
+
         try:
             response = bucket_config.client.get_object(**bucket_config.boto_kwargs(
                 Key=bucket_config.object_key(name, version),
@@ -444,9 +623,69 @@ class HatracStorage:
             except Exception as ev:
                 if "hatrac_request_trace" in hatrac_ctx:
                     hatrac_ctx.hatrac_request_trace("S3 read error: %s" % ev)
+            finally:
+                # hand the socket back to the client pool even when the
+                # HTTP client disconnects before the body is consumed
+                response['Body'].close()
+
+        if parallel:
+            return length, metadata, self._parallel_read_generator(
+                bucket_config, name, version, version_id, response, partsize, nbytes
+            )
+
+        if length <= self._bufsize:
+            # a body that fits one read is taken now, releasing the pooled
+            # connection before the response starts instead of after it
+            try:
+                body = response['Body'].read()
+            finally:
+                response['Body'].close()
+            return length, metadata, iter([body])
 
         return length, metadata, data_generator(response)
 
+    def _parallel_read_generator(self, bucket_config, name, version, version_id, first_response, partsize, nbytes):
+        """Generate whole-object content from concurrent ranged GETs, in order.
+
+           The first part was already requested by the caller.  Up to
+           _read_ahead later parts are fetched through transfer_pool
+           while earlier ones are yielded.
+        """
+        def fetch(start, stop):
+            response = bucket_config.client.get_object(**bucket_config.boto_kwargs(
+                Key=bucket_config.object_key(name, version),
+                Range='bytes=%d-%d' % (start, stop - 1),
+                VersionId=version_id,
+            ))
+            try:
+                return response['Body'].read()
+            finally:
+                response['Body'].close()
+
+        ranges = ( (start, min(start + partsize, nbytes)) for start in range(partsize, nbytes, partsize) )
+        pending = deque([
+            self.transfer_pool.submit(fetch, *part)
+            for part in itertools.islice(ranges, self._read_ahead)
+        ])
+        try:
+            for chunk in iter(lambda: first_response['Body'].read(self._bufsize), b''):
+                yield chunk
+            while pending:
+                data = pending.popleft().result()
+                part = next(ranges, None)
+                if part is not None:
+                    pending.append(self.transfer_pool.submit(fetch, *part))
+                yield data
+        except Exception as ev:
+            if has_app_context() and "hatrac_request_trace" in hatrac_ctx:
+                hatrac_ctx.hatrac_request_trace("S3 read error: %s" % ev)
+            # the full length was already promised, so the server must abort the response
+            raise
+        finally:
+            first_response['Body'].close()
+            for future in pending:
+                future.cancel()
+
     @s3_bucket_wrap()
     def delete(self, name, version, aux={}, bucket_config=None):
         """Delete object version."""
@@ -467,6 +706,55 @@ class HatracStorage:
             #hatrac_debug('got unexpected ClientError in amazons3 delete', e, type(e), e.response)
             raise
 
+    def delete_many(self, versions):
+        """Delete object versions in bulk, returning a list of (name, version, error) failures.
+
+           versions: iterable of (name, version, aux) tuples
+
+           Keys are grouped by bucket and removed with DeleteObjects
+           requests of up to _delete_batch keys each.
+        """
+        buckets = {}
+        for name, version, aux in versions:
+            bucket_config = self.bucket_mapper.get_bucket_config(name)
+            s3_version = aux.get("version") if aux else None
+            version_id = version.strip() if not s3_version else s3_version.strip()
+            obj = bucket_config.boto_kwargs(
+                Bucket=False,
+                Key=bucket_config.object_key(name, version),
+                VersionId=version_id,
+            )
+            buckets.setdefault(bucket_config, []).append((name, version, obj))
+
+        failures = []
+        for bucket_config, entries in buckets.items():
+            for i in range(0, len(entries), self._delete_batch):
+                batch = entries[i:i+self._delete_batch]
+                try:
+                    response = bucket_config.client.delete_objects(
+                        Bucket=bucket_config.bucket_name,
+                        Delete={'Objects': [ obj for name, version, obj in batch ], 'Quiet': True},
+                    )
+                except ClientError as e:
+                    failures.extend([ (name, version, e) for name, version, obj in batch ])
+                    continue
+                errors = {
+                    (error['Key'], error.get('VersionId')): error
+                    for error in response.get('Errors', [])
+                }
+                if errors:
+                    for name, version, obj in batch:
+                        error = errors.get((obj['Key'], obj.get('VersionId')))
+                        if error is None:
+                            continue
+                        message = '%s: %s' % (error.get('Code'), error.get('Message'))
+                        if error.get('Code') in {'NoSuchKey', 'NoSuchVersion'}:
+                            # these matter for overlay backend scenarios, as in delete()
+                            failures.append((name, version, ObjectVersionMissing(message)))
+                        else:
+                            failures.append((name, version, message))
+        return failures
+
     @s3_bucket_wrap()
     def create_upload(self, name, nbytes=None, metadata={}, bucket_config=None):
         # thread version state needed for _some_ naming schemes
@@ -490,10 +778,11 @@ class HatracStorage:
                 PartNumber=position + 1,
                 Body=inp,
                 ContentLength=length,
+                ContentMD5=md5,
             ))
             return dict(etag=response['ETag'])
 
-        return self._send_content_from_stream(input, nbytes, metadata, helper, chunksize)
+        return self._send_content_from_stream(input, nbytes, metadata, helper)
 
     @s3_bucket_wrap()
     def cancel_upload(self, name, upload_id, bucket_config=None):
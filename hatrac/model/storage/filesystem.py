@@ -14,16 +14,12 @@ import os
 import hashlib
 import base64
 import binascii
-import random
-import struct
 import io
 
 from ...core import BadRequest, Conflict, ObjectVersionMissing, coalesce
 
 def make_random_version():
-    return base64.b32encode(
-        struct.pack('QQ', random.getrandbits(64), random.getrandbits(64))[0:26]
-    ).decode().replace('=', '') # strip off '=' padding
+    return base64.b32encode(os.urandom(16)).decode().rstrip('=') # strip off '=' padding
 
 def make_file(dirname, relname, accessmode):
     """Create and open file with accessmode, including missing parents.
@@ -55,6 +51,9 @@ class HatracStorage (object):
     """
     track_chunks = False
 
+    min_chunksize = 1
+    max_chunks = None
+
     _bufsize = 1024**2
 
     def __init__(self, config):
@@ -263,6 +262,19 @@ class HatracStorage (object):
             # this matters for overlay backend scenarios
             raise ObjectVersionMissing(e)
 
+    def delete_many(self, versions):
+        """Delete object versions in bulk, returning a list of (name, version, error) failures.
+
+           versions: iterable of (name, version, aux) tuples
+        """
+        failures = []
+        for name, version, aux in versions:
+            try:
+                self.delete(name, version, aux=aux)
+            except Exception as e:
+                failures.append((name, version, e))
+        return failures
+
     def delete_namespace(self, name):
         """Tidy up after an empty namespace that has been deleted."""
         dirname, relname = self._dirname_relname(name, 'dummy')
@@ -115,6 +115,14 @@ class HatracStorage (object):
     def track_chunks(self):
         return self.backends[0].track_chunks
 
+    @property
+    def min_chunksize(self):
+        return self.backends[0].min_chunksize
+
+    @property
+    def max_chunks(self):
+        return self.backends[0].max_chunks
+
     def create_from_file(self, name, input, nbytes, metadata={}):
         return self.backends[0].create_from_file(name, input, nbytes, metadata)
 
@@ -157,6 +165,14 @@ class HatracStorage (object):
             # this is expected if the client deletes a version not in primary storage
             pass
 
+    def delete_many(self, versions):
+        # versions missing from primary storage are expected, as for delete()
+        return [
+            failure
+            for failure in self.backends[0].delete_many(versions)
+            if not isinstance(failure[2], ObjectVersionMissing)
+        ]
+
     def delete_namespace(self, name):
         # this opportunistic cleanup only applies to the filesystem backend in practice
         return self.backends[0].delete_namespace(name)
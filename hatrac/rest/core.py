@@ -39,6 +39,11 @@ from .. import directory
 
 _webauthn2_manager = Manager()
 
+# config is loaded at import, so the URL name filter can be compiled once
+_url_name_re = re.compile(
+    "^(" + core.config.get("allowed_url_char_class", '[-._~A-Za-z0-9/]') + "|%[0-9a-fA-F][0-9a-fA-F])+$"
+)
+
 def hash_value(d):
     return base64.b64encode(hashlib.md5(d.encode()).digest()).decode()
 
@@ -346,9 +351,7 @@ class RestHandler (flask.views.MethodView):
 
     def resolve(self, path, name, raise_notfound=True):
         fullname = self._fullname(path, name)
-        allowed_char_class = core.config.get("allowed_url_char_class", '[-._~A-Za-z0-9/]')
-        pat = "^(" + allowed_char_class + "|%[0-9a-fA-F][0-9a-fA-F])+$"
-        if not re.match(pat, fullname):
+        if not _url_name_re.match(fullname):
             raise BadRequest('Request malformed. Hatrac URL path names may only include characters A-Z, a-z, 0-9, "-", ".", "~", or UTF-8 bytes percent-encoded with 2-digit hex values.')
         return hatrac_ctx.hatrac_directory.name_resolve(fullname, raise_notfound)
 
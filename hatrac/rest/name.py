@@ -82,7 +82,7 @@ class NameVersions (RestHandler):
         ).get_versions()
         # ugly but safe: hash the ordered list of versions as content ETag 
         self.set_http_etag(
-            hash_list([ r.asurl() for r in resource.object.directory.object_enumerate_versions(resource.object)])
+            hash_list(resource.object.directory.object_enumerate_version_strings(resource.object))
         )
         self.http_check_preconditions()
         return self.get_content(
@@ -132,7 +132,7 @@ class Name (RestHandler):
             )
         elif not resource.is_object():
             self.set_http_etag(
-                hash_list([ r.asurl() for r in resource.directory.namespace_enumerate_names(resource, False, False)])
+                hash_list(resource.directory.namespace_enumerate_name_strings(resource, False))
             )
             self.http_check_preconditions('PUT')
             resource.enforce_acl(['owner'])
@@ -195,7 +195,7 @@ class Name (RestHandler):
         else:
             # check preconditions on namespace
             self.set_http_etag(
-                hash_list([ r.asurl() for r in resource.directory.namespace_enumerate_names(resource, False, False)])
+                hash_list(resource.directory.namespace_enumerate_name_strings(resource, False))
             )
             self.http_check_preconditions('DELETE')
         resource.delete(
@@ -214,7 +214,7 @@ class Name (RestHandler):
             self.set_http_etag(resource.version)
         else:
             self.set_http_etag(
-                hash_list([ r.asurl() for r in resource.directory.namespace_enumerate_names(resource, False, False)])
+                hash_list(resource.directory.namespace_enumerate_name_strings(resource, False))
             )
         self.http_check_preconditions()
         body, status, headers = self.get_content(
@@ -740,6 +740,34 @@ dotest "204::*::*" "${upload}?cid=smoke" -X DELETE
 douploadtest "/ns-${RUNKEY}/foo2/obj2" "${upload_md5}" "" "201::text/uri-list::*" "204::*::*" "204::*::*" "201::*::*"
 dotest "200::application/x-bash::${upload_total_bytes}" /ns-${RUNKEY}/foo2/obj2
 
+# check upload job whose size is an exact multiple of chunk size (no short final chunk)
+exact_file_name="/tmp/parts-${RUNKEY}exact"
+exact_total_bytes=$(( 2 * ${chunk_bytes} ))
+head -c ${exact_total_bytes} /dev/urandom > ${exact_file_name}
+split -b ${chunk_bytes} -d ${exact_file_name} ${exact_file_name}-
+head -c 1000 ${exact_file_name} > ${exact_file_name}-short
+cat > ${TEST_DATA} <<EOF
+{
+  "content-length": ${exact_total_bytes},
+  "content-type": "application/octet-stream",
+  "chunk-length": ${chunk_bytes}
+}
+EOF
+dotest "201::text/uri-list::*" "/ns-${RUNKEY}/foo2/obj5;upload" \
+       -T "${TEST_DATA}" \
+       -X POST \
+       -H "Content-Type: application/json"
+upload="$(cat ${RESPONSE_CONTENT})"
+upload="${upload#/hatrac}"
+# the last chunk must still be full-size when there is no remainder
+dotest "409::*::*" "${upload}/1" -T "${exact_file_name}-short"
+# position nchunks would be an empty final chunk
+dotest "409::*::*" "${upload}/2" -T "${exact_file_name}-short"
+dotest "204::*::*" "${upload}/0" -T "${exact_file_name}-00"
+dotest "204::*::*" "${upload}/1" -T "${exact_file_name}-01"
+dotest "201::*::*" "${upload}" -X POST
+dotest "200::application/octet-stream::${exact_total_bytes}" /ns-${RUNKEY}/foo2/obj5
+
 # check upload job for brand new object canceled implicitly by object deletion
 douploadtest "/ns-${RUNKEY}/foo/obj4" "${upload_md5}" "" "201::text/uri-list::*" "204::*::*" "204::*::*"
 dotest "200::application/json::*" "${upload}"